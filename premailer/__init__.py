@@ -1,3 +1,9 @@
-from .premailer import Premailer, transform  # noqa
+from .premailer import (  # noqa
+    Premailer,
+    CompiledStylesheet,
+    CompiledTemplate,
+    transform,
+    transform_many,
+)
 
 __version__ = "3.10.0"
@@ -1,3 +1,4 @@
+import io
 import sys
 import argparse
 
@@ -21,9 +22,9 @@ def main(args):
         "-f",
         "--file",
         nargs="?",
-        type=argparse.FileType("r"),
+        type=argparse.FileType("rb"),
         help="Specifies the input file.  The default is stdin.",
-        default=sys.stdin,
+        default=None,
         dest="infile",
     )
 
@@ -31,9 +32,9 @@ def main(args):
         "-o",
         "--output",
         nargs="?",
-        type=argparse.FileType("w"),
+        type=argparse.FileType("wb"),
         help="Specifies the output file.  The default is stdout.",
-        default=sys.stdout,
+        default=None,
         dest="outfile",
     )
 
@@ -145,7 +146,9 @@ def main(args):
     )
 
     parser.add_argument(
-        "--encoding", default="utf-8", help="Output encoding. The default is utf-8"
+        "--encoding",
+        default=None,
+        help="Output encoding. The default is that of the input, or utf-8",
     )
 
     parser.add_argument(
@@ -167,9 +170,10 @@ def main(args):
     if options.disable_basic_attributes:
         options.disable_basic_attributes = options.disable_basic_attributes.split()
 
-    html = options.infile.read()
-    if hasattr(html, "decode"):  # Forgive me: Python 2 compatability
-        html = html.decode("utf-8")
+    # The bytes, whatever their encoding, unless stdin is replaced with
+    # something that only has text.
+    infile = options.infile or getattr(sys.stdin, "buffer", sys.stdin)
+    html = infile.read()
 
     p = Premailer(
         html=html,
@@ -189,9 +193,16 @@ def main(args):
         allow_insecure_ssl=options.allow_insecure_ssl,
         allow_loading_external_files=options.allow_loading_external_files,
     )
-    options.outfile.write(
-        p.transform(encoding=options.encoding, pretty_print=options.pretty)
-    )
+    outfile = options.outfile or getattr(sys.stdout, "buffer", sys.stdout)
+    kwargs = {}
+    if options.encoding:
+        kwargs["encoding"] = options.encoding
+    if isinstance(outfile, io.TextIOBase):
+        outfile.write(p.transform(pretty_print=options.pretty, **kwargs))
+    else:
+        outfile.write(
+            p.transform(pretty_print=options.pretty, output="bytes", **kwargs)
+        )
     return 0
 
 
@@ -0,0 +1,72 @@
+"""HTTP clients for loading external stylesheets in
+``Premailer.atransform()``::
+
+    async with aiohttp.ClientSession() as session:
+        html = await Premailer(html).atransform(client=AiohttpClient(session))
+
+A client is anything with a coroutine method
+``get(url, headers=None, verify=True, timeout=None)`` which returns a
+response like that of ``requests``, with a ``status_code``, ``text``,
+``headers`` and ``raise_for_status()``.
+"""
+import asyncio
+import functools
+
+import requests
+
+
+class Response(object):
+    def __init__(self, url, status_code, text, headers=None):
+        self.url = url
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(
+                "%s Error for url: %s" % (self.status_code, self.url), response=self
+            )
+
+
+class ExecutorClient(object):
+    """Makes the requests with a ``requests`` session (or ``requests``
+    itself) in an executor, the event loop's default one unless given, so
+    they don't block the event loop. This is the default client."""
+
+    def __init__(self, session=None, executor=None):
+        self.session = session or requests
+        self.executor = executor
+
+    async def get(self, url, headers=None, verify=True, timeout=None):
+        kwargs = {}
+        if headers:
+            kwargs["headers"] = headers
+        if timeout is not None:
+            kwargs["timeout"] = timeout
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self.executor,
+            functools.partial(self.session.get, url, verify=verify, **kwargs),
+        )
+
+
+class AiohttpClient(object):
+    """Makes the requests with an ``aiohttp.ClientSession``."""
+
+    def __init__(self, session):
+        self.session = session
+
+    async def get(self, url, headers=None, verify=True, timeout=None):
+        import aiohttp
+
+        kwargs = {}
+        if headers:
+            kwargs["headers"] = headers
+        if not verify:
+            kwargs["ssl"] = False
+        if timeout is not None:
+            kwargs["timeout"] = aiohttp.ClientTimeout(total=timeout)
+        async with self.session.get(url, **kwargs) as response:
+            text = await response.text()
+            return Response(url, response.status, text, response.headers)
@@ -1,5 +1,6 @@
 import functools
 import os
+import sys
 import threading
 
 import cachetools
@@ -18,9 +19,6 @@ TTL_CACHE_TIMEOUT = 1 * 60 * 60
 # Maximum no. of items to be saved in cache.
 DEFAULT_CACHE_MAXSIZE = 128
 
-# Lock to prevent multiple threads from accessing the cache at same time.
-cache_access_lock = threading.RLock()
-
 cache_type = os.environ.get("PREMAILER_CACHE", "LFU")
 if cache_type not in CACHE_IMPLEMENTATIONS:
     raise ValueError(
@@ -28,24 +26,180 @@ if cache_type not in CACHE_IMPLEMENTATIONS:
         % "/".join(CACHE_IMPLEMENTATIONS.keys())
     )
 
-cache_init_options = {
+# Every function decorated with function_cache() gets a cache of its own.
+# These are the caches by name.
+caches = {}
+
+# Locks to prevent multiple threads from accessing a cache at same time.
+_locks = {}
+
+# Hits, misses and evictions of the caches by name.
+_stats = {}
+
+# Deprecated: the cache that all the functions used to share, and its lock.
+# Setting ``cache`` to another cache makes them all share that one again, but
+# otherwise it's not used. Use ``set_cache()`` and ``clear()`` instead.
+cache_access_lock = threading.RLock()
+_shared_cache_options = {
     "maxsize": int(os.environ.get("PREMAILER_CACHE_MAXSIZE", DEFAULT_CACHE_MAXSIZE))
 }
 if cache_type == "TTL":
-    cache_init_options["ttl"] = int(
+    _shared_cache_options["ttl"] = int(
         os.environ.get("PREMAILER_CACHE_TTL", TTL_CACHE_TIMEOUT)
     )
+cache = _unused_cache = CACHE_IMPLEMENTATIONS[cache_type](**_shared_cache_options)
+
+
+def _environ(name, setting=""):
+    """Returns the PREMAILER_CACHE_<NAME><SETTING> environment variable,
+    falling back to PREMAILER_CACHE<SETTING>."""
+    default = os.environ.get("PREMAILER_CACHE%s" % setting)
+    return os.environ.get("PREMAILER_CACHE_%s%s" % (name.upper(), setting), default)
+
+
+def new_cache(name, maxbytes=None):
+    """Creates a cache for the named function as configured by the
+    environment. For example, for the "selector" cache:
+
+    - ``PREMAILER_CACHE_SELECTOR`` or ``PREMAILER_CACHE``
+    - ``PREMAILER_CACHE_SELECTOR_MAXSIZE`` or ``PREMAILER_CACHE_MAXSIZE``
+    - ``PREMAILER_CACHE_SELECTOR_MAXBYTES`` or ``PREMAILER_CACHE_MAXBYTES``
+    - ``PREMAILER_CACHE_SELECTOR_TTL`` or ``PREMAILER_CACHE_TTL``
+
+    With a maximum number of bytes (``maxbytes`` unless a maximum size is
+    configured) the cache is limited by the approximate memory use of the
+    values instead of their number.
+    """
+    type_ = _environ(name) or cache_type
+    if type_ not in CACHE_IMPLEMENTATIONS:
+        raise ValueError(
+            "Unsupported cache implementation. Available options: %s"
+            % "/".join(CACHE_IMPLEMENTATIONS.keys())
+        )
+    maxsize = _environ(name, "_MAXSIZE")
+    maxbytes = _environ(name, "_MAXBYTES") or (None if maxsize else maxbytes)
+    if maxbytes:
+        options = {"maxsize": int(maxbytes), "getsizeof": approximate_size}
+    else:
+        options = {"maxsize": int(maxsize or DEFAULT_CACHE_MAXSIZE)}
+    if type_ == "TTL":
+        options["ttl"] = int(_environ(name, "_TTL") or TTL_CACHE_TIMEOUT)
+    return CACHE_IMPLEMENTATIONS[type_](**options)
+
 
-cache = CACHE_IMPLEMENTATIONS[cache_type](**cache_init_options)
+def set_cache(name, cache):
+    """Replaces the cache of the named function, e.g. with one of a
+    different size or implementation."""
+    with _locks.setdefault(name, threading.RLock()):
+        caches[name] = cache
+        _stats.setdefault(name, {"hits": 0, "misses": 0, "evictions": 0})
 
 
-def function_cache(**options):
+def clear(name=None):
+    """Empties the cache of the named function, or all the caches."""
+    for each in [name] if name else list(caches):
+        with _locks[each]:
+            caches[each].clear()
+
+
+def _approximate_size(obj, seen):
+    """The size in bytes of an object and, if it's a built-in container,
+    of what it contains."""
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += _approximate_size(key, seen) + _approximate_size(value, seen)
+    elif isinstance(obj, (tuple, list, set, frozenset)):
+        for item in obj:
+            size += _approximate_size(item, seen)
+    return size
+
+
+def approximate_size(obj):
+    """The size in bytes of an object, see ``_approximate_size()``."""
+    return _approximate_size(obj, set())
+
+
+def stats():
+    """Returns the hits, misses, evictions, current size, maximum size and
+    approximate memory use in bytes of every cache, by name. The memory
+    doesn't include what's inside objects other than built-in types."""
+    result = {}
+    for name, cache in list(caches.items()):
+        with _locks[name]:
+            seen = set()
+            result[name] = dict(
+                _stats[name],
+                size=len(cache),
+                maxsize=cache.maxsize,
+                memory=sum(
+                    _approximate_size(key, seen) + _approximate_size(value, seen)
+                    for key, value in cache.items()
+                ),
+            )
+    return result
+
+
+def reset_stats(name=None):
+    """Sets the hits, misses and evictions of the named function's cache, or
+    all the caches, back to zero."""
+    for each in [name] if name else list(_stats):
+        with _locks[each]:
+            _stats[each].update(hits=0, misses=0, evictions=0)
+
+
+def function_cache(name=None, key=None, maxbytes=None):
+    """Caches the return values of the decorated function in a cache of its
+    own, registered in ``caches`` as ``name`` (defaults to the function's
+    name).
+
+    The values are cached by the arguments, or by what ``key`` returns when
+    called with them. The cache holds ``maxbytes`` of values, if given,
+    instead of a number of them (see ``new_cache()``).
+    """
+
     def decorator(func):
-        @cachetools.cached(cache, lock=cache_access_lock)
+        cache_name = name or func.__name__
+        if cache_name not in caches:
+            set_cache(cache_name, new_cache(cache_name, maxbytes=maxbytes))
+        own_lock = _locks[cache_name]
+        counts = _stats[cache_name]
+
         @functools.wraps(func)
         def inner(*args, **kwargs):
-            return func(*args, **kwargs)
+            if cache is _unused_cache:
+                store, lock = caches[cache_name], own_lock
+            else:
+                store, lock = cache, cache_access_lock
+            # In case the same cache is used for more than one function.
+            if key is None:
+                cache_key = cachetools.keys.hashkey(cache_name, *args, **kwargs)
+            else:
+                cache_key = (cache_name, key(*args, **kwargs))
+            with lock:
+                try:
+                    value = store[cache_key]
+                except KeyError:
+                    counts["misses"] += 1
+                else:
+                    counts["hits"] += 1
+                    return value
+            value = func(*args, **kwargs)
+            with lock:
+                # Another thread might have added it in the meantime.
+                size = len(store) + (cache_key not in store)
+                try:
+                    store[cache_key] = value
+                except ValueError:
+                    pass  # value too large
+                else:
+                    counts["evictions"] += size - len(store)
+            return value
 
+        inner.cache_name = cache_name
         return inner
 
     return decorator
@@ -0,0 +1,180 @@
+"""A cache of the stylesheets loaded over HTTP(S), for sharing between
+``Premailer`` instances::
+
+    stylesheet_cache = StylesheetCache(maxbytes=10 * 1024 * 1024)
+    for html in documents:
+        Premailer(html, stylesheet_cache=stylesheet_cache).transform()
+
+A stylesheet is used for as long as the ``Cache-Control`` (``max-age``)
+or ``Expires`` headers of the response allow. After that, or if the
+response said ``no-cache``, it's revalidated with ``If-None-Match`` and
+``If-Modified-Since`` if it had an ``ETag`` or ``Last-Modified`` header.
+Responses with ``no-store``, or with no way of knowing whether they're
+still valid, aren't stored.
+"""
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from email.utils import parsedate_to_datetime
+
+import cachetools
+
+
+# ``expires`` is the time (as in ``time.time()``) until which it can be
+# used without asking the server.
+Entry = namedtuple("Entry", ["text", "etag", "last_modified", "expires"])
+
+_max_age = re.compile(r"(?:^|,)\s*max-age\s*=\s*\"?(\d+)", re.I)
+_no_cache = re.compile(r"(?:^|,)\s*(no-cache|no-store)\b", re.I)
+
+
+def _timestamp(value):
+    """Returns the ``time.time()`` of an HTTP date, or ``None``."""
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def _freshness(headers, now):
+    """Returns until when a response can be used without revalidating it,
+    or ``None`` if it mustn't be stored at all."""
+    cache_control = headers.get("cache-control", "")
+    no_cache = [x.lower() for x in _no_cache.findall(cache_control)]
+    if "no-store" in no_cache:
+        return None
+    if "no-cache" in no_cache:
+        return now
+    max_age = _max_age.search(cache_control)
+    if max_age:
+        try:
+            age = int(headers.get("age", 0))
+        except ValueError:
+            age = 0
+        return now + int(max_age.group(1)) - age
+    if "expires" in headers:
+        expires = _timestamp(headers["expires"])
+        if expires is None:
+            # Invalid dates mean it has already expired.
+            return now
+        date = _timestamp(headers.get("date")) or now
+        return now + expires - date
+    return now
+
+
+class StylesheetCache(object):
+    """Stores up to ``maxbytes`` (roughly) of stylesheets in memory, the
+    least recently used ones making way for new ones, and, if a
+    ``directory`` is given, all of them on disk as well."""
+
+    def __init__(self, maxbytes=10 * 1024 * 1024, directory=None):
+        self.maxbytes = maxbytes
+        self.directory = directory
+        self._memory = cachetools.LRUCache(
+            maxsize=maxbytes, getsizeof=lambda entry: len(entry.text)
+        )
+        self._lock = threading.RLock()
+
+    def _path(self, url):
+        name = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, name + ".json")
+
+    def get(self, url):
+        """Returns the ``Entry`` of a url or ``None``."""
+        with self._lock:
+            entry = self._memory.get(url)
+        if entry is None and self.directory:
+            try:
+                with open(self._path(url), encoding="utf-8") as f:
+                    entry = Entry(**json.load(f))
+            except (OSError, ValueError, TypeError):
+                return None
+            self._remember(url, entry)
+        return entry
+
+    def set(self, url, entry):
+        self._remember(url, entry)
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            # Write it all or nothing in case other processes are reading it.
+            fd, temporary = tempfile.mkstemp(dir=self.directory)
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump(entry._asdict(), f)
+                os.replace(temporary, self._path(url))
+            except OSError:
+                os.unlink(temporary)
+                raise
+
+    def _remember(self, url, entry):
+        with self._lock:
+            try:
+                self._memory[url] = entry
+            except ValueError:
+                pass  # too large
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+        if self.directory and os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.endswith(".json"):
+                    os.unlink(os.path.join(self.directory, name))
+
+    def load(self, url, get):
+        """Returns the text of the stylesheet at ``url``, from the cache if
+        it's still fresh. Otherwise it's fetched with ``get(url, headers)``
+        which returns a ``requests`` response."""
+        entry = self.get(url)
+        now = time.time()
+        if entry is not None and now < entry.expires:
+            return entry.text
+        response = get(url, self._request_headers(entry))
+        return self._update(url, entry, response, now)
+
+    async def aload(self, url, get):
+        """Same as ``load()`` but ``get(url, headers)`` is a coroutine
+        function."""
+        entry = self.get(url)
+        now = time.time()
+        if entry is not None and now < entry.expires:
+            return entry.text
+        response = await get(url, self._request_headers(entry))
+        return self._update(url, entry, response, now)
+
+    @staticmethod
+    def _request_headers(entry):
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
+        return headers
+
+    def _update(self, url, entry, response, now):
+        """Stores the response if it can be and returns its text."""
+        response_headers = {
+            key.lower(): value
+            for key, value in getattr(response, "headers", {}).items()
+        }
+        etag = response_headers.get("etag")
+        last_modified = response_headers.get("last-modified")
+        if entry is not None and response.status_code == 304:
+            # Not modified
+            text = entry.text
+            etag = etag or entry.etag
+            last_modified = last_modified or entry.last_modified
+        else:
+            response.raise_for_status()
+            text = response.text
+
+        expires = _freshness(response_headers, now)
+        if expires is not None and (expires > now or etag or last_modified):
+            self.set(url, Entry(text, etag, last_modified, expires))
+        return text
@@ -0,0 +1,138 @@
+"""Hooks for measuring where ``Premailer.transform()`` spends its time.
+
+Pass ``Premailer(instrumentation=...)`` an ``Instrumentation`` (or a
+function, see below) and it's told when each of these spans starts and
+stops:
+
+``parse_html``
+    Parsing the html. ``bytes``: the length of the html.
+``stylesheet``
+    Loading and parsing each ``<style>`` or ``<link>`` (``tag``, ``href``)
+    of the document.
+``load``
+    Loading an external stylesheet (``url``). With
+    ``max_concurrent_fetches`` it happens in another thread. Not told by
+    ``atransform()``.
+``parse_css``
+    Parsing a stylesheet. ``rules``: the number of rules to apply and
+    ``leftover``: the number of rules that can't be in-lined.
+``prune``
+    With ``prune_unused_css``, finding which of the ``selectors`` of the
+    rules that can't be in-lined apply to anything. ``unused``: the number
+    of those that don't.
+``match``
+    Finding the elements each rule applies to (``engine``, ``rules``).
+    ``elements``: the number of elements any rule applies to and
+    ``skipped``: the number of rules that can't apply to any.
+``select``
+    Finding the elements one rule applies to (``selector``), by the
+    ``xpath`` engine. ``elements``: the number of elements.
+``merge``
+    Merging the rules of each element into its style attribute
+    (``elements``).
+``basic_attributes``
+    Setting attributes like ``bgcolor`` from the styles (``elements``).
+``post_process``
+    Removing the classes, capitalizing the float and margin properties,
+    aligning the floating images and joining the links with the
+    ``base_url``, as asked for, in one walk over the document.
+    ``elements``: the number of elements walked over.
+``serialize``
+    Turning the document into html. ``bytes``: the length of the html.
+
+Both events get the name of the span and a dictionary of data about it.
+The counts are added to the dictionary before the span stops.
+"""
+import contextlib
+import threading
+import time
+
+
+class Instrumentation(object):
+    """Does nothing. Override ``start()`` and ``stop()`` to do something."""
+
+    def start(self, name, data):
+        pass
+
+    def stop(self, name, data):
+        pass
+
+
+class Callback(Instrumentation):
+    """Calls a function with ``("start" or "stop", name, data)``."""
+
+    def __init__(self, function):
+        self.function = function
+
+    def start(self, name, data):
+        self.function("start", name, data)
+
+    def stop(self, name, data):
+        self.function("stop", name, data)
+
+
+class Timings(Instrumentation):
+    """Adds up how many times each span happened, how long it took and its
+    counts, by name, in ``totals``. For example::
+
+        timings = Timings()
+        Premailer(html, instrumentation=timings).transform()
+        timings.totals["parse_css"]
+        {'calls': 1, 'seconds': 0.00012, 'rules': 4, 'leftover': 1}
+    """
+
+    def __init__(self):
+        self.totals = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def start(self, name, data):
+        try:
+            stack = self._local.stack
+        except AttributeError:
+            stack = self._local.stack = []
+        stack.append(time.perf_counter())
+
+    def stop(self, name, data):
+        seconds = time.perf_counter() - self._local.stack.pop()
+        with self._lock:
+            totals = self.totals.setdefault(name, {"calls": 0, "seconds": 0.0})
+            totals["calls"] += 1
+            totals["seconds"] += seconds
+            for key, value in data.items():
+                if isinstance(value, int) and not isinstance(value, bool):
+                    totals[key] = totals.get(key, 0) + value
+
+
+class _NoSpan(object):
+    """What spans are without instrumentation. The data written to it is
+    never looked at."""
+
+    def __init__(self):
+        self.data = {}
+
+    def __enter__(self):
+        return self.data
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_no_span = _NoSpan()
+
+
+@contextlib.contextmanager
+def _span(instrumentation, name, data):
+    instrumentation.start(name, data)
+    try:
+        yield data
+    finally:
+        instrumentation.stop(name, data)
+
+
+def span(instrumentation, name, **data):
+    """Returns a context manager for a span which gives the dictionary to
+    put the counts in."""
+    if instrumentation is None:
+        return _no_span
+    return _span(instrumentation, name, data)
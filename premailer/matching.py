@@ -0,0 +1,512 @@
+"""Engines for finding which elements of a document each rule applies to.
+
+Both engines take the document, a list of rules sorted by specificity and
+the ``Instrumentation`` (or ``None``) and return a list of
+``(element, [rule, ...])`` where the rules of each element are in the same
+order as in the list.
+
+``xpath``
+    Evaluates every rule's ``CSSSelector`` against the whole document.
+
+``single-pass``
+    Walks the document once. Rules are put in buckets keyed by the id,
+    a class or the tag name of the rightmost compound selector (or a
+    universal bucket) so that for each element only the rules that
+    could possibly apply to it need to be looked at, and those are
+    verified right to left like a browser does. Selectors it doesn't
+    understand are matched with their ``CSSSelector`` instead.
+
+Before either, the rules which require an id, class or tag that isn't in the
+document at all are left out with ``possible_rules()``.
+
+``selectors_in_use()`` finds, with either engine, which selectors apply to
+anything in the document at all.
+"""
+import re
+
+from cssselect import SelectorError, parse
+from cssselect.parser import (
+    Attrib,
+    Class,
+    CombinedSelector,
+    Element,
+    Function,
+    Hash,
+    Negation,
+    Pseudo,
+    parse_series,
+)
+from lxml import etree
+from lxml.cssselect import CSSSelector
+
+from premailer.cache import function_cache
+from premailer.instrumentation import span
+
+
+class UnsupportedSelector(Exception):
+    pass
+
+
+# What XPath's normalize-space() considers whitespace.
+_whitespace = re.compile(r"[ \t\n\r]+")
+
+
+def _split_words(value):
+    return _whitespace.split(value.strip(" \t\n\r"))
+
+
+def _value(token):
+    # cssselect >= 1.2 gives us Token objects, older versions strings.
+    return getattr(token, "value", token)
+
+
+class _Context(object):
+    """State that is shared by all the tests during one walk of a document."""
+
+    def __init__(self):
+        self._siblings = {}
+
+    def siblings(self, element):
+        """Returns the element siblings of an element (including itself)
+        and the element's position among them."""
+        try:
+            return self._siblings[id(element)]
+        except KeyError:
+            pass
+        parent = element.getparent()
+        if parent is None:
+            siblings = [element]
+        else:
+            siblings = [x for x in parent if isinstance(x.tag, str)]
+        for i, sibling in enumerate(siblings):
+            self._siblings[id(sibling)] = (siblings, i)
+        return self._siblings[id(element)]
+
+
+def _nth(a, b, count):
+    """Whether ``count`` siblings before (or after) an element satisfy
+    ``an+b``."""
+    position = count + 1
+    if a == 0:
+        return position == b
+    return (position - b) % a == 0 and (position - b) // a >= 0
+
+
+def _compile_attrib(node):
+    if node.namespace:
+        raise UnsupportedSelector(node)
+    name = node.attrib
+    operator = node.operator
+    value = _value(node.value)
+    if operator == "exists":
+        return lambda element, context: name in element.attrib
+    if operator == "=":
+        return lambda element, context: element.get(name) == value
+    if operator == "!=":
+        return lambda element, context: element.get(name) != value
+    if operator == "~=":
+        if not value or _whitespace.search(value):
+            return lambda element, context: False
+        return lambda element, context: (
+            name in element.attrib and value in _split_words(element.get(name))
+        )
+    if operator == "|=":
+        prefix = value + "-"
+        return lambda element, context: (
+            element.get(name) is not None
+            and (element.get(name) == value or element.get(name).startswith(prefix))
+        )
+    if operator in ("^=", "$=", "*="):
+        if not value:
+            return lambda element, context: False
+        method = {"^=": "startswith", "$=": "endswith", "*=": "__contains__"}[
+            operator
+        ]
+        return lambda element, context: getattr(element.get(name, ""), method)(value)
+    raise UnsupportedSelector(node)
+
+
+def _compile_pseudo(node, tag):
+    ident = node.ident
+    if ident.endswith("-of-type"):
+        if tag is None:
+            raise UnsupportedSelector(node)
+
+        def siblings(element, context):
+            siblings, position = context.siblings(element)
+            same = [x for x in siblings if x.tag == tag]
+            return same, same.index(element)
+
+    else:
+
+        def siblings(element, context):
+            return context.siblings(element)
+
+    if ident in ("first-child", "first-of-type"):
+        return lambda element, context: siblings(element, context)[1] == 0
+    if ident in ("last-child", "last-of-type"):
+
+        def test(element, context):
+            these, position = siblings(element, context)
+            return position == len(these) - 1
+
+        return test
+    if ident in ("only-child", "only-of-type"):
+        return lambda element, context: len(siblings(element, context)[0]) == 1
+    if ident == "empty":
+
+        def test(element, context):
+            if element.text:
+                return False
+            for child in element:
+                if isinstance(child.tag, str) or child.tail:
+                    return False
+            return True
+
+        return test
+    if ident == "root":
+        return lambda element, context: element.getparent() is None
+    raise UnsupportedSelector(node)
+
+
+def _compile_function(node, tag):
+    name = node.name
+    try:
+        a, b = parse_series(node.arguments)
+    except ValueError:
+        raise UnsupportedSelector(node)
+    if name in ("nth-child", "nth-last-child"):
+        tag = None
+    elif name not in ("nth-of-type", "nth-last-of-type") or tag is None:
+        raise UnsupportedSelector(node)
+    last = name.startswith("nth-last-")
+
+    def test(element, context):
+        siblings, position = context.siblings(element)
+        if tag is not None:
+            siblings = [x for x in siblings if x.tag == tag]
+            position = siblings.index(element)
+        if last:
+            return _nth(a, b, len(siblings) - 1 - position)
+        return _nth(a, b, position)
+
+    return test
+
+
+def _compound_parts(node):
+    """Yields the simple selectors of a compound selector, the element
+    (type or universal) selector last."""
+    while not isinstance(node, Element):
+        if isinstance(node, CombinedSelector):
+            raise UnsupportedSelector(node)
+        yield node
+        try:
+            node = node.selector
+        except AttributeError:
+            raise UnsupportedSelector(node)
+    yield node
+
+
+def _compound_tag(node):
+    for part in _compound_parts(node):
+        if isinstance(part, Element):
+            if part.namespace:
+                raise UnsupportedSelector(part)
+            return part.element if part.element not in (None, "*") else None
+
+
+def _compile_compound(node):
+    tag = _compound_tag(node)
+    tests = []
+    for part in _compound_parts(node):
+        if isinstance(part, Element):
+            if tag is not None:
+                tests.append(lambda element, context: element.tag == tag)
+        elif isinstance(part, Hash):
+            tests.append(
+                lambda element, context, id_=part.id: element.get("id") == id_
+            )
+        elif isinstance(part, Class):
+            tests.append(
+                lambda element, context, class_=part.class_name: (
+                    "class" in element.attrib
+                    and class_ in _split_words(element.get("class"))
+                )
+            )
+        elif isinstance(part, Attrib):
+            tests.append(_compile_attrib(part))
+        elif isinstance(part, Pseudo):
+            tests.append(_compile_pseudo(part, tag))
+        elif isinstance(part, Function):
+            tests.append(_compile_function(part, tag))
+        elif isinstance(part, Negation):
+            negated = _compile(part.subselector)
+            tests.append(
+                lambda element, context, negated=negated: not negated(
+                    element, context
+                )
+            )
+        else:
+            raise UnsupportedSelector(part)
+    # Cheap tests (tag, id, class) are added last but should be tried first.
+    tests.reverse()
+
+    if len(tests) == 1:
+        return tests[0]
+
+    def test(element, context):
+        for each in tests:
+            if not each(element, context):
+                return False
+        return True
+
+    return test
+
+
+def _compile(node):
+    if not isinstance(node, CombinedSelector):
+        return _compile_compound(node)
+
+    left = _compile(node.selector)
+    right = _compile_compound(node.subselector)
+    combinator = node.combinator
+    if combinator == " ":
+
+        def test(element, context):
+            if not right(element, context):
+                return False
+            for ancestor in element.iterancestors():
+                if left(ancestor, context):
+                    return True
+            return False
+
+    elif combinator == ">":
+
+        def test(element, context):
+            if not right(element, context):
+                return False
+            parent = element.getparent()
+            return parent is not None and left(parent, context)
+
+    elif combinator == "+":
+
+        def test(element, context):
+            if not right(element, context):
+                return False
+            siblings, position = context.siblings(element)
+            return position > 0 and left(siblings[position - 1], context)
+
+    elif combinator == "~":
+
+        def test(element, context):
+            if not right(element, context):
+                return False
+            siblings, position = context.siblings(element)
+            for sibling in siblings[:position]:
+                if left(sibling, context):
+                    return True
+            return False
+
+    else:
+        raise UnsupportedSelector(node)
+    return test
+
+
+def _bucket(node):
+    """Returns what the rightmost compound selector requires of an
+    element, as ``("id", value)``, ``("class", value)``, ``("tag", value)``
+    or ``("*", None)``."""
+    if isinstance(node, CombinedSelector):
+        node = node.subselector
+    best = ("*", None)
+    for part in _compound_parts(node):
+        if isinstance(part, Hash):
+            return ("id", part.id)
+        elif isinstance(part, Class):
+            best = ("class", part.class_name)
+        elif isinstance(part, Element) and best[0] == "*":
+            if part.element not in (None, "*"):
+                best = ("tag", part.element)
+    return best
+
+
+@function_cache("selector")
+def _create_cssselector(selector):
+    return CSSSelector(selector)
+
+
+@function_cache("matcher")
+def compile_selector(selector):
+    """Returns ``(bucket, test)`` for a selector or ``None`` if the
+    single-pass engine can't match it by itself."""
+    try:
+        (parsed,) = parse(selector)
+    except (SelectorError, ValueError):
+        return None
+    if parsed.pseudo_element:
+        return None
+    try:
+        return _bucket(parsed.parsed_tree), _compile(parsed.parsed_tree)
+    except UnsupportedSelector:
+        return None
+
+
+def _requirements(node):
+    """Yields what any element in the document must be for a selector to
+    match anything, as ``("id", value)``, ``("class", value)`` or
+    ``("tag", value)``. Nothing is required by what's within ``:not()``."""
+    while isinstance(node, CombinedSelector):
+        yield from _requirements(node.subselector)
+        node = node.selector
+    while True:
+        if isinstance(node, Hash):
+            yield ("id", node.id)
+        elif isinstance(node, Class):
+            yield ("class", node.class_name)
+        elif isinstance(node, Element):
+            if not node.namespace and node.element not in (None, "*"):
+                yield ("tag", node.element)
+            return
+        try:
+            node = node.selector
+        except AttributeError:
+            return
+
+
+@function_cache("requirements", maxbytes=4 * 1024 * 1024)
+def selector_requirements(selector):
+    """Returns the ids, classes and tags a document needs to have for a
+    selector to possibly match anything in it (see ``document_index()``)."""
+    try:
+        (parsed,) = parse(selector)
+    except (SelectorError, ValueError):
+        return frozenset()
+    return frozenset(_requirements(parsed.parsed_tree))
+
+
+def document_index(page):
+    """Returns the ids, classes and tags there are in the document, in one
+    walk of it, like ``selector_requirements()``."""
+    index = set()
+    for element in page.iter(etree.Element):
+        index.add(("tag", element.tag))
+        attrib = element.attrib
+        if "id" in attrib:
+            index.add(("id", attrib["id"]))
+        if "class" in attrib:
+            classes = attrib["class"].strip(" \t\n\r")
+            if classes:
+                index.update(("class", x) for x in _whitespace.split(classes))
+    return index
+
+
+def possible_rules(page, rules):
+    """Returns the rules which could possibly match an element of the
+    document, without those requiring an id, class or tag that isn't in it.
+    """
+    index = document_index(page)
+    return [rule for rule in rules if selector_requirements(rule.selector) <= index]
+
+
+class _Probe(object):
+    """Stands in for a rule in ``selectors_in_use()``."""
+
+    __slots__ = ("selector", "_cssselector")
+
+    def __init__(self, selector):
+        self.selector = selector
+        self._cssselector = None
+
+    @property
+    def cssselector(self):
+        if self._cssselector is None:
+            self._cssselector = _create_cssselector(self.selector)
+        return self._cssselector
+
+
+def selectors_in_use(page, selectors, engine="xpath", instrumentation=None):
+    """Returns which of the selectors apply to at least one element of the
+    document, found with one of the ``ENGINES``. Those that can't be
+    compiled are assumed to be in use."""
+    in_use = set()
+    probes = []
+    for probe in possible_rules(page, [_Probe(x) for x in selectors]):
+        # Only build the CSSSelector if the engine will use it.
+        if engine != "single-pass" or compile_selector(probe.selector) is None:
+            try:
+                probe.cssselector
+            except SelectorError:
+                in_use.add(probe.selector)
+                continue
+        probes.append(probe)
+    for element, matched in ENGINES[engine](page, probes, instrumentation):
+        in_use.update(probe.selector for probe in matched)
+    return in_use
+
+
+def match_xpath(page, rules, instrumentation=None):
+    elements = {}
+    for rule in rules:
+        with span(instrumentation, "select", selector=rule.selector) as counts:
+            items = rule.cssselector(page)
+            counts["elements"] = len(items)
+        for item in items:
+            # id is unique for the lifetime of the object and lxml
+            # gives us the same object every time during this run.
+            try:
+                elements[id(item)][1].append(rule)
+            except KeyError:
+                elements[id(item)] = (item, [rule])
+    return list(elements.values())
+
+
+def match_single_pass(page, rules, instrumentation=None):
+    buckets = {"id": {}, "class": {}, "tag": {}}
+    universal = []
+    tests = []
+    for position, rule in enumerate(rules):
+        compiled = compile_selector(rule.selector)
+        if compiled is None:
+            matched = set(rule.cssselector(page))
+            if not matched:
+                tests.append(None)
+                continue
+            bucket = ("*", None)
+            test = lambda element, context, matched=matched: element in matched  # noqa
+        else:
+            bucket, test = compiled
+        tests.append(test)
+        if bucket[0] == "*":
+            universal.append(position)
+        else:
+            buckets[bucket[0]].setdefault(bucket[1], []).append(position)
+
+    by_id = buckets["id"]
+    by_class = buckets["class"]
+    by_tag = buckets["tag"]
+    context = _Context()
+    matches = []
+    for element in page.iter(etree.Element):
+        candidates = list(universal)
+        if by_id:
+            id_ = element.get("id")
+            if id_ is not None and id_ in by_id:
+                candidates.extend(by_id[id_])
+        if by_class:
+            classes = element.get("class")
+            if classes:
+                for class_ in set(_split_words(classes)):
+                    if class_ in by_class:
+                        candidates.extend(by_class[class_])
+        if element.tag in by_tag:
+            candidates.extend(by_tag[element.tag])
+        if not candidates:
+            continue
+        candidates.sort()
+        matched = [rules[i] for i in candidates if tests[i](element, context)]
+        if matched:
+            matches.append((element, matched))
+    return matches
+
+
+ENGINES = {"xpath": match_xpath, "single-pass": match_single_pass}
@@ -1,4 +1,5 @@
 import cssutils
+import re
 import threading
 from collections import OrderedDict
 
@@ -12,12 +13,155 @@ def format_value(prop):
         return prop.propertyValue.cssText.strip()
 
 
-@function_cache()
+# Whitespace, semicolons and comments between declarations.
+_separators = re.compile(r"(?:\s|;|/\*.*?\*/)*", re.S)
+_declaration = re.compile(
+    r"""
+    (?P<name>-?[a-zA-Z_][a-zA-Z0-9_-]*)\s*:\s*
+    (?P<value>(?:
+        [^;!"'()\\/]
+        |/(?!\*)
+        |"[^"\\\n]*"
+        |'[^'\\\n]*'
+        |url\(\s*(?:"[^"\\\n]*"|'[^'\\\n]*'|[^\s()'"\\]*)\s*\)
+    )+?)
+    \s*(?:!\s*(?P<priority>[a-zA-Z]+)\s*)?
+    (?:;|$)
+    """,
+    re.X,
+)
+# The kinds of values that cssutils doesn't change, or that are easy to
+# change the same way.
+_value_token = re.compile(
+    r"""
+    (?P<space>\s*)
+    (?:
+        (?P<delimiter>[,/])
+        |url\(\s*(?:"(?P<dq_url>[^"]*)"|'(?P<sq_url>[^']*)'|(?P<url>[^\s()'"]*))\s*\)
+        |(?P<ident>-?[a-zA-Z_][a-zA-Z0-9_-]*)
+        |(?P<number>[+-]?(?:0|[1-9][0-9]*)(?:\.[0-9]*[1-9])?)(?P<unit>%|[a-zA-Z]+)?
+        |(?P<hash>\#[0-9a-fA-F]+)
+        |(?P<string>"[^"]*"|'[^']*')
+    )
+    """,
+    re.X,
+)
+# The units cssutils leaves out of a zero.
+_dropped_zero_units = frozenset(("px", "em", "ex", "cm", "mm", "in", "pt", "pc"))
+# When cssutils puts quotes around a url.
+_forbidden_in_uri = re.compile(r"""[()\s;,'"]""")
+
+
+def _format_value_token(token):
+    """Returns the token the way cssutils would serialize it or ``None``
+    if not sure."""
+    if token.group("ident"):
+        return token.group("ident")
+    if token.group("number"):
+        number, unit = token.group("number"), token.group("unit")
+        if number.lstrip("+-") == "0":
+            if number != "0":
+                return None
+            if unit and unit.lower() in _dropped_zero_units:
+                # cssutils drops the unit of zero lengths
+                return number
+            if unit and unit != "%":
+                # but not of zero times, angles, rem and so on
+                return None
+        return number + (unit.lower() if unit else "")
+    if token.group("hash"):
+        value = token.group("hash")
+        if len(value) == 4:
+            return value
+        if len(value) == 7:
+            if value[1::2] == value[2::2]:
+                # #aabbcc is shortened to #abc
+                return "#" + value[1::2]
+            return value
+        return None
+    if token.group("string"):
+        return '"%s"' % token.group("string")[1:-1].replace('"', '\\"')
+    url = token.group("dq_url") or token.group("sq_url") or token.group("url")
+    if not url:
+        return None
+    if _forbidden_in_uri.search(url):
+        return 'url("%s")' % url.replace('"', '\\"')
+    return "url(%s)" % url
+
+
+def _format_value(value):
+    parts = []
+    # Whether the last token was a delimiter (or there was none yet).
+    delimited = True
+    position = 0
+    while position < len(value):
+        token = _value_token.match(value, position)
+        if not token:
+            return None
+        position = token.end()
+        delimiter = token.group("delimiter")
+        if delimiter:
+            if delimited:
+                return None
+            parts.append(", " if delimiter == "," else "/")
+            delimited = True
+            continue
+        formatted = _format_value_token(token)
+        if formatted is None:
+            return None
+        if not delimited:
+            if not token.group("space"):
+                return None
+            parts.append(" ")
+        parts.append(formatted)
+        delimited = False
+    if delimited:
+        return None
+    return "".join(parts)
+
+
+def _parse_declarations(csstext):
+    """Does what ``cssutils.parseStyle`` (without validation) does to a
+    list of declarations, but only for the common and simple cases where
+    it's certain to come up with the same. Returns ``None`` otherwise.
+    """
+    pairs = []
+    names = set()
+    position = _separators.match(csstext).end()
+    while position < len(csstext):
+        declaration = _declaration.match(csstext, position)
+        if not declaration:
+            return None
+        name = declaration.group("name").lower()
+        if name in names:
+            return None
+        names.add(name)
+        value = _format_value(declaration.group("value"))
+        if value is None:
+            return None
+        priority = declaration.group("priority")
+        if priority:
+            if priority.lower() != "important":
+                return None
+            value += " !important"
+        pairs.append((name, value))
+        position = _separators.match(csstext, declaration.end()).end()
+    return pairs
+
+
+@function_cache("declarations")
 def csstext_to_pairs(csstext, validate=True):
     """
     csstext_to_pairs takes css text and make it to list of
     tuple of key,value.
+
+    Unless asked to validate, simple declarations are parsed without
+    ``cssutils`` (and its lock).
     """
+    if not validate:
+        pairs = _parse_declarations(csstext)
+        if pairs is not None:
+            return pairs
     # The lock is required to avoid ``cssutils`` concurrency
     # issues documented in issue #65
     with csstext_to_pairs._lock:
@@ -30,6 +174,68 @@ def csstext_to_pairs(csstext, validate=True):
 csstext_to_pairs._lock = threading.RLock()
 
 
+def _declarations_text(declarations, remove_unset_properties):
+    if remove_unset_properties:
+        # Remove rules that we were going to have value 'unset' because
+        # they effectively are the same as not saying anything about the
+        # property when inlined
+        return "; ".join(
+            "%s:%s" % (k, v)
+            for k, v in declarations.items()
+            if not v.lower() == "unset"
+        )
+    return "; ".join("%s:%s" % (k, v) for k, v in declarations.items())
+
+
+class StyleAccumulator(object):
+    """The declarations of the rules of one element as they're added, the
+    later overriding the earlier, by pseudoclass ("" for none). Turned into
+    the element's style, with its old inline style, with ``to_string()``.
+    """
+
+    __slots__ = ("normal", "pseudo")
+
+    def __init__(self):
+        self.normal = OrderedDict()
+        self.pseudo = None
+
+    def add(self, pairs, pseudoclass=""):
+        """Adds ``(name, value)`` pairs of a rule."""
+        if not pseudoclass:
+            self.normal.update(pairs)
+            return
+        if self.pseudo is None:
+            self.pseudo = OrderedDict()
+        try:
+            self.pseudo[pseudoclass].update(pairs)
+        except KeyError:
+            self.pseudo[pseudoclass] = OrderedDict(pairs)
+
+    def to_string(self, inline_style="", remove_unset_properties=False):
+        """Returns the final style. The old inline style always overrides
+        the rules. It's added to the declarations so call it only once."""
+        normal = self.normal
+        if inline_style:
+            # inline should be a declaration list as I understand
+            # ie property-name:property-value;...
+            normal.update(csstext_to_pairs(inline_style))
+        normal_style = _declarations_text(normal, remove_unset_properties)
+        if not self.pseudo:
+            return normal_style.strip()
+
+        pseudo_styles = []
+        for pseudoclass, declarations in self.pseudo.items():
+            text = _declarations_text(declarations, remove_unset_properties)
+            if text:
+                pseudo_styles.append("%s{%s}" % (pseudoclass, text))
+        if not pseudo_styles:
+            return normal_style.strip()
+        if normal_style:
+            # inline style definition: declarations without braces
+            pseudo_styles.insert(0, "{%s}" % normal_style)
+        return " ".join(pseudo_styles).strip()
+
+
 def merge_styles(inline_style, new_styles, classes, remove_unset_properties=False):
     """
     This will merge all new styles where the order is important
@@ -50,51 +256,7 @@ def merge_styles(inline_style, new_styles, classes, remove_unset_properties=Fals
     Returns:
         str: the final style
     """
-    # building classes
-    styles = OrderedDict([("", OrderedDict())])
-    for pc in set(classes):
-        styles[pc] = OrderedDict()
-
-    for i, style in enumerate(new_styles):
-        for k, v in style:
-            styles[classes[i]][k] = v
-
-    # keep always the old inline style
-    if inline_style:
-        # inline should be a declaration list as I understand
-        # ie property-name:property-value;...
-        for k, v in csstext_to_pairs(inline_style):
-            styles[""][k] = v
-
-    normal_styles = []
-    pseudo_styles = []
-    for pseudoclass, kv in styles.items():
-        if remove_unset_properties:
-            # Remove rules that we were going to have value 'unset' because
-            # they effectively are the same as not saying anything about the
-            # property when inlined
-            kv = OrderedDict(
-                (k, v) for (k, v) in kv.items() if not v.lower() == "unset"
-            )
-        if not kv:
-            continue
-        if pseudoclass:
-            pseudo_styles.append(
-                "%s{%s}"
-                % (pseudoclass, "; ".join("%s:%s" % (k, v) for k, v in kv.items()))
-            )
-        else:
-            normal_styles.append("; ".join("%s:%s" % (k, v) for k, v in kv.items()))
-
-    if pseudo_styles:
-        # if we do or code thing correct this should not happen
-        # inline style definition: declarations without braces
-        all_styles = (
-            (["{%s}" % "".join(normal_styles)] + pseudo_styles)
-            if normal_styles
-            else pseudo_styles
-        )
-    else:
-        all_styles = normal_styles
-
-    return " ".join(all_styles).strip()
+    styles = StyleAccumulator()
+    for style, pseudoclass in zip(new_styles, classes):
+        styles.add(style, pseudoclass)
+    return styles.to_string(inline_style, remove_unset_properties)
@@ -0,0 +1,247 @@
+"""Parsers for turning a stylesheet into the rules premailer works with.
+
+Both parsers take the text of a stylesheet and return a tuple of
+``StyleRule`` and ``MediaRule``. Other top-level rules (``@import``,
+``@font-face``, ``@keyframes``, comments...) are left out because
+nothing is done with them.
+
+``cssutils``
+    Parses (and, if asked to, validates) the stylesheet with ``cssutils``.
+
+``fast``
+    A small tokenizer that doesn't validate anything and isn't bothered
+    by invalid CSS, it only splits the stylesheet into rules and
+    declarations. It normalizes selectors and values the way ``cssutils``
+    does for the common cases, so the rules come out the same.
+"""
+import re
+from collections import namedtuple
+
+import cssutils
+
+from premailer.merge_style import _format_value, csstext_to_pairs
+
+
+Declaration = namedtuple("Declaration", ["name", "value", "priority"])
+
+# ``declarations`` only has the one declaration of each property that
+# counts, e.g. the last one or the last "!important" one.
+StyleRule = namedtuple("StyleRule", ["selector_text", "declarations"])
+
+# ``rules`` are ``StyleRule`` and ``OtherRule``.
+MediaRule = namedtuple("MediaRule", ["media_text", "rules"])
+
+# Anything else within a ``MediaRule``, like a comment, as text.
+OtherRule = namedtuple("OtherRule", ["css_text"])
+
+
+def _indent(css_text):
+    return "\n".join("    " + line for line in css_text.split("\n"))
+
+
+def to_string(rule, important=False):
+    """Serializes a rule the way ``cssutils`` does, optionally with every
+    declaration made "!important"."""
+    if isinstance(rule, OtherRule):
+        return rule.css_text
+    if isinstance(rule, MediaRule):
+        nested = [to_string(x, important) for x in rule.rules]
+        nested = [_indent(x) for x in nested if x]
+        if not nested:
+            return ""
+        return "@media %s {\n%s\n    }" % (rule.media_text, "\n".join(nested))
+    declarations = []
+    for declaration in rule.declarations:
+        text = "    %s: %s" % (declaration.name, declaration.value)
+        if important or declaration.priority == "important":
+            text += " !important"
+        declarations.append(text)
+    if not declarations:
+        return ""
+    return "%s {\n%s\n    }" % (rule.selector_text, ";\n".join(declarations))
+
+
+def _from_cssutils(rule):
+    if rule.type == rule.STYLE_RULE:
+        return StyleRule(
+            rule.selectorText,
+            tuple(
+                Declaration(prop.name, prop.value, prop.priority)
+                for prop in rule.style.getProperties()
+            ),
+        )
+    return OtherRule(rule.cssText)
+
+
+def parse_cssutils(css_body, validate=True):
+    # The same lock as for ``cssutils`` concurrency issues documented
+    # in issue #65
+    with csstext_to_pairs._lock:
+        sheet = cssutils.parseString(css_body, validate=validate)
+        rules = []
+        for rule in sheet:
+            if rule.type == rule.MEDIA_RULE:
+                rules.append(
+                    MediaRule(
+                        rule.media.mediaText,
+                        tuple(_from_cssutils(x) for x in rule.cssRules),
+                    )
+                )
+            elif rule.type == rule.STYLE_RULE:
+                rules.append(_from_cssutils(rule))
+        return tuple(rules)
+
+
+_token = re.compile(
+    r"""
+    (?P<comment>/\*.*?(?:\*/|$))
+    |(?P<string>"(?:[^"\\\n]|\\.)*"?|'(?:[^'\\\n]|\\.)*'?)
+    |(?P<url>[uU][rR][lL]\([^()"']*\))
+    |(?P<open>\{)
+    |(?P<close>\})
+    |(?P<semicolon>;)
+    |(?P<other>(?:[^/"'{};\\uU]|\\.)+|.)
+    """,
+    re.X | re.S,
+)
+_whitespace = re.compile(r"\s+")
+_selector_part = re.compile(
+    r"""
+    "(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'
+    |\[[^\]]*\]
+    |\((?:[^()]|\([^()]*\))*\)
+    |\\.
+    |(?P<combinator>\s*[>+~,]\s*|\s+)
+    """,
+    re.X,
+)
+_media_feature = re.compile(r"\s*:\s*")
+_priority = re.compile(r"!\s*important\s*$", re.I)
+
+
+def _tokenize(css_body):
+    return [(token.lastgroup, token.group()) for token in _token.finditer(css_body)]
+
+
+def _text(tokens):
+    """The text of some tokens without the comments and with runs of
+    whitespace (outside of strings) made one space."""
+    return "".join(
+        _whitespace.sub(" ", value) if kind == "other" else value
+        for kind, value in tokens
+        if kind != "comment"
+    ).strip()
+
+
+def _normalize_selector(selector_text):
+    """Puts one space around combinators and after commas like ``cssutils``
+    does, except within strings, brackets and parentheses."""
+
+    def normalize(match):
+        combinator = match.group("combinator")
+        if combinator is None:
+            return match.group()
+        combinator = combinator.strip()
+        if not combinator:
+            return " "
+        if combinator == ",":
+            return ", "
+        return " %s " % combinator
+
+    return _selector_part.sub(normalize, selector_text).strip()
+
+
+def _block_end(tokens, position):
+    """Returns the position of the token after the ``}`` that closes the
+    block at ``position``."""
+    depth = 0
+    while position < len(tokens):
+        kind = tokens[position][0]
+        position += 1
+        if kind == "open":
+            depth += 1
+        elif kind == "close":
+            depth -= 1
+            if depth <= 0:
+                return position
+    return position
+
+
+def _parse_declarations(tokens):
+    """Returns the declarations that count from the tokens of a
+    declaration block."""
+    declarations = {}
+    start = 0
+    for position in range(len(tokens) + 1):
+        if position < len(tokens) and tokens[position][0] != "semicolon":
+            continue
+        declaration = _text(tokens[start:position])
+        start = position + 1
+        name, colon, value = declaration.partition(":")
+        name = name.strip().lower()
+        value = value.strip()
+        priority = ""
+        match = _priority.search(value)
+        if match:
+            priority = "important"
+            value = value[: match.start()].rstrip()
+        if not colon or not name or not value:
+            continue
+        value = _format_value(value) or value
+        existing = declarations.get(name)
+        if existing and existing[1].priority and not priority:
+            continue
+        declarations[name] = (position, Declaration(name, value, priority))
+    return tuple(x for _, x in sorted(declarations.values()))
+
+
+def _parse_rules(tokens, position, nested):
+    """Parses rules from ``position`` up to the end of the tokens or, if
+    ``nested``, the end of the block. Returns the rules and the position
+    after them."""
+    rules = []
+    start = position
+    while position < len(tokens):
+        kind, value = tokens[position]
+        if kind == "comment" and nested and position == start:
+            rules.append(OtherRule(value))
+            start = position = position + 1
+        elif kind in ("semicolon", "close"):
+            # @import and the like, or junk
+            start = position = position + 1
+            if kind == "close" and nested:
+                break
+        elif kind != "open":
+            if kind == "other" and not value.strip() and position == start:
+                start += 1
+            position += 1
+        else:
+            prelude = _text(tokens[start:position])
+            end = _block_end(tokens, position)
+            if prelude[:6].lower() == "@media":
+                # the block ends where the rules in it end
+                media_rules, end = _parse_rules(tokens, position + 1, True)
+                media_text = _media_feature.sub(": ", prelude[6:].strip())
+                rules.append(MediaRule(media_text, tuple(media_rules)))
+            elif prelude.startswith("@"):
+                if nested:
+                    css_text = "".join(value for _, value in tokens[start:end])
+                    rules.append(OtherRule(css_text.strip()))
+            elif prelude:
+                block = tokens[position + 1 : end]  # noqa: E203
+                if block and block[-1][0] == "close":
+                    block.pop()
+                rules.append(
+                    StyleRule(_normalize_selector(prelude), _parse_declarations(block))
+                )
+            start = position = end
+    return rules, position
+
+
+def parse_fast(css_body, validate=True):
+    """``validate`` is ignored."""
+    rules, _ = _parse_rules(_tokenize(css_body), 0, False)
+    return tuple(rules)
+
+
+PARSERS = {"cssutils": parse_cssutils, "fast": parse_fast}
@@ -1,22 +1,55 @@
+import asyncio
 import codecs
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
 import operator
 import os
+import pickle
 import re
+import uuid
 import warnings
-from collections import OrderedDict
-from html import escape, unescape
-from urllib.parse import urljoin, urlparse, unquote
+from collections import OrderedDict, namedtuple
+from urllib.parse import urljoin, urlparse
 
+import cssselect
 import cssutils
 import requests
 from lxml import etree
-from lxml.cssselect import CSSSelector
 
+from premailer.aio import ExecutorClient
 from premailer.cache import function_cache
-from premailer.merge_style import csstext_to_pairs, merge_styles
+from premailer.instrumentation import Callback, Instrumentation, span
+from premailer.matching import (
+    ENGINES as MATCHING_ENGINES,
+    _create_cssselector,
+    possible_rules,
+    selectors_in_use,
+)
+from premailer.merge_style import (  # noqa: F401 merge_styles used to be used here
+    StyleAccumulator,
+    csstext_to_pairs,
+    merge_styles,
+)
+from premailer.parsing import (
+    PARSERS as CSS_PARSERS,
+    MediaRule,
+    OtherRule,
+    StyleRule,
+    to_string,
+)
+from premailer.result_cache import Result
 
 
-__all__ = ["PremailerError", "Premailer", "transform"]
+__all__ = [
+    "PremailerError",
+    "Premailer",
+    "CompiledStylesheet",
+    "CompiledTemplate",
+    "transform",
+    "transform_many",
+]
 
 
 class PremailerError(Exception):
@@ -31,6 +64,71 @@ class ExternalFileLoadingError(Exception):
     pass
 
 
+# The parsed html of a document, its <style> and <link> elements, the urls of
+# the stylesheets to load, the encoding of the html if it was bytes and the
+# ``_TemplateTags`` of the handlebars to put back, if they're preserved.
+_Document = namedtuple(
+    "_Document",
+    ["root", "page", "tree", "elements", "urls", "encoding", "handlebars"],
+)
+
+
+# What the html returned by transform() depends on, besides the html given,
+# the keyword arguments and the external stylesheets.
+_RESULT_OPTIONS = (
+    "attribute_name",
+    "base_url",
+    "disable_link_rewrites",
+    "preserve_internal_links",
+    "preserve_inline_attachments",
+    "preserve_handlebar_syntax",
+    "exclude_pseudoclasses",
+    "keep_style_tags",
+    "remove_classes",
+    "capitalize_float_margin",
+    "include_star_selectors",
+    "external_styles",
+    "css_text",
+    "strip_important",
+    "method",
+    "base_path",
+    "disable_basic_attributes",
+    "disable_validation",
+    "disable_leftover_css",
+    "align_floating_images",
+    "remove_unset_properties",
+    "allow_network",
+    "allow_loading_external_files",
+    "matching_engine",
+    "css_parser",
+    "prune_unused_css",
+)
+
+
+def _texts_digest(texts):
+    digest = hashlib.sha1()
+    for text in texts:
+        if isinstance(text, str):
+            data = text.encode("utf-8", "surrogatepass")
+        else:
+            data = text
+        digest.update(b"%d:" % len(data))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def _declares_encoding(html):
+    """Whether the html, bytes, says what its encoding is with a byte order
+    mark, a ``<meta charset>`` or the XML declaration."""
+    if bytes(html[:3]).startswith(_boms):
+        return True
+    return _charset_regex.search(html, 0, 1024) is not None
+
+
+def _is_url(location):
+    return location.startswith("http://") or location.startswith("https://")
+
+
 def make_important(bulk):
     """makes every property in a string !important."""
     return ";".join(
@@ -51,29 +149,369 @@ def get_or_create_head(root):
         return head[0]
 
 
-@function_cache()
-def _cache_parse_css_string(css_body, validate=True):
+def _stylesheet_key(css_body, validate=True, parser="cssutils"):
+    """A digest of the stylesheet instead of all of it, to not keep the
+    text in memory for as long as its rules are cached."""
+    digest = hashlib.sha1(css_body.encode("utf-8", "surrogatepass")).digest()
+    return digest, validate, parser
+
+
+@function_cache("stylesheet", key=_stylesheet_key, maxbytes=32 * 1024 * 1024)
+def _cache_parse_css_string(css_body, validate=True, parser="cssutils"):
     """
-    This function will cache the result from cssutils
+    This function will cache the result from the CSS parser
     It is a big gain when number of rules is big
-    Maximum cache entries are 1000. This is mainly for
+    The cache holds up to 32MB of parsed rules by default. This is mainly for
     protecting memory leak in case something gone wild.
     Be aware that you can turn the cache off in Premailer
 
     Args:
         css_body(str): css rules in string format
         validate(bool): if cssutils should validate
+        parser(str): which of the ``premailer.parsing.PARSERS`` to use
 
     Returns:
-        cssutils.css.cssstylesheet.CSSStyleSheet
+        tuple: the ``StyleRule`` and ``MediaRule`` of the stylesheet
+
+    """
+    return CSS_PARSERS[parser](css_body, validate=validate)
+
+
+class _FileText(str):
+    """The text of a stylesheet file, with its ``_Styles`` by
+    ``(validate, parser, *options)`` once they've been parsed."""
+
+    def __new__(cls, text):
+        self = super().__new__(cls, text)
+        self.parsed = {}
+        return self
+
+
+@function_cache("file")
+def _cache_read_file(path, mtime_ns, size):
+    """Reads a stylesheet file. It's cached by its modification time and size
+    as well so that it's read again when it changes."""
+    with codecs.open(path, encoding="utf-8") as f:
+        return _FileText(f.read())
+
+
+def _read_file(path):
+    stat = os.stat(path)
+    return _cache_read_file(os.path.realpath(path), stat.st_mtime_ns, stat.st_size)
+
+
+# The rules of a stylesheet the way they're used with some options, worked
+# out once and cached. ``rules`` are ``(is_important, id_count, class_count,
+# element_count, selector, bulk)``, the specificity without the
+# ``ruleset_index`` and the rule's index number (its position), ``leftover``
+# are the rules that can't be in-lined and ``leftover_text`` is those as CSS
+# with every declaration made "!important".
+_Styles = namedtuple("_Styles", ["rules", "leftover", "leftover_text"])
+
+_no_styles = _Styles((), (), "")
+
+
+def _css_rules_to_string(rules):
+    """given a list of css rules returns a css string"""
+    lines = []
+    for item in rules:
+        # media rule
+        if isinstance(item, MediaRule):
+            lines.append(to_string(item, important=True))
+        else:
+            k, v = item
+            lines.append("%s {%s}" % (k, make_important(v)))
+    return "\n".join(lines)
+
+
+# Pseudo-classes and pseudo-elements, and strings and attribute selectors
+# so that what's in those is left alone.
+_pseudo_regex = re.compile(r"""("[^"]*"|'[^']*'|\[[^\]]*\])|::?[-\w]+(?:\([^)]*\))?""")
+
+
+def _without_pseudo(selector):
+    """Returns the selector without its pseudo-classes and pseudo-elements,
+    for the elements it could apply to in some state."""
+    return _pseudo_regex.sub(lambda match: match.group(1) or "", selector).strip()
+
+
+def _leftover_selectors(rules):
+    """Yields the selectors of leftover rules, including those in the
+    ``MediaRule``."""
+    for item in rules:
+        if isinstance(item, MediaRule):
+            for rule in item.rules:
+                if isinstance(rule, StyleRule):
+                    for selector in rule.selector_text.split(","):
+                        yield selector.strip()
+        else:
+            yield item[0]
+
+
+def _prune_rules(rules, in_use):
+    """Returns the leftover rules without the selectors for which
+    ``in_use(selector)`` is false, and the rules left with none."""
+    pruned = []
+    for item in rules:
+        if isinstance(item, MediaRule):
+            nested = []
+            for rule in item.rules:
+                if isinstance(rule, OtherRule):
+                    # Anything but comments, which go with the pruned rules.
+                    if not rule.css_text.startswith("/*"):
+                        nested.append(rule)
+                    continue
+                selectors = [x.strip() for x in rule.selector_text.split(",")]
+                used = [x for x in selectors if in_use(x)]
+                if len(used) == len(selectors):
+                    nested.append(rule)
+                elif used:
+                    nested.append(rule._replace(selector_text=", ".join(used)))
+            if nested:
+                pruned.append(item._replace(rules=tuple(nested)))
+        elif in_use(item[0]):
+            pruned.append(item)
+    return pruned
+
+
+def _prepare_styles(
+    sheet, strip_important, exclude_pseudoclasses, include_star_selectors
+):
+    """Returns the ``_Styles`` of a parsed stylesheet."""
+
+    def format_css_property(prop):
+        if strip_important or prop.priority != "important":
+            return "{0}:{1}".format(prop.name, prop.value)
+        else:
+            return "{0}:{1} !important".format(prop.name, prop.value)
+
+    def join_css_properties(properties):
+        """Accepts a list of Declaration objects and returns
+        a semicolon delimitted string like 'color: red; font-size: 12px'
+        """
+        return ";".join(format_css_property(prop) for prop in properties)
+
+    leftover = []
+    rules = []
+    for rule in sheet:
+        # handle media rule
+        if isinstance(rule, MediaRule):
+            leftover.append(rule)
+            continue
+        # only proceed for things we recognize
+        if not isinstance(rule, StyleRule):
+            continue
+
+        # normal means it doesn't have "!important"
+        normal_properties = [
+            prop for prop in rule.declarations if prop.priority != "important"
+        ]
+        important_properties = [
+            prop for prop in rule.declarations if prop.priority == "important"
+        ]
+
+        # Create three strings that we can use to add to the `rules`
+        # list later as ready blocks of css.
+        bulk_normal = join_css_properties(normal_properties)
+        bulk_important = join_css_properties(important_properties)
+        bulk_all = join_css_properties(normal_properties + important_properties)
+
+        selectors = (
+            x.strip()
+            for x in rule.selector_text.split(",")
+            if x.strip() and not x.strip().startswith("@")
+        )
+        for selector in selectors:
+            if (
+                ":" in selector
+                and exclude_pseudoclasses
+                and ":" + selector.split(":", 1)[1] not in FILTER_PSEUDOSELECTORS
+            ):
+                # a pseudoclass
+                leftover.append((selector, bulk_all))
+                continue
+            elif "*" in selector and not include_star_selectors:
+                continue
+            elif selector.startswith(":"):
+                continue
+
+            id_count, class_count, element_count = _specificity(selector)
+
+            # Within one rule individual properties have different
+            # priority depending on !important.
+            # So we split each rule into two: one that includes all
+            # the !important declarations and another that doesn't.
+            for is_important, bulk in ((1, bulk_important), (0, bulk_normal)):
+                if not bulk:
+                    # don't bother adding empty css rules
+                    continue
+                rules.append(
+                    (is_important, id_count, class_count, element_count, selector, bulk)
+                )
+    return _Styles(tuple(rules), tuple(leftover), _css_rules_to_string(leftover))
+
+
+def _specificity(selector):
+    """Returns the ``(ids, classes, elements)`` specificity of a selector, in
+    which attributes and pseudo-classes count as classes and the argument of
+    ``:not()`` counts as it would on its own. If ``cssselect`` can't parse
+    the selector it's calculated crudely."""
+    try:
+        return cssselect.parse(selector)[0].specificity()
+    except cssselect.SelectorError:
+        return (
+            selector.count("#"),
+            selector.count("."),
+            len(_element_selector_regex.findall(selector)),
+        )
+
+
+def _index_rules(rules, ruleset_index):
+    """Returns the ``(specificity, selector, bulk)`` of the ``rules`` of
+    ``_Styles``."""
+    indexed = []
+    for index, rule in enumerate(rules):
+        specificity = rule[:4] + (ruleset_index, index)
+        indexed.append((specificity, rule[4], rule[5]))
+    return indexed
+
+
+def _styles_key(css_body, validate, parser, *options):
+    return _stylesheet_key(css_body, validate, parser) + options
+
+
+@function_cache("styles", key=_styles_key, maxbytes=32 * 1024 * 1024)
+def _cache_parse_styles(
+    css_body, validate, parser, strip_important, exclude_pseudoclasses, star
+):
+    """Caches the ``_Styles`` of a stylesheet for some options, which
+    are immutable and shared by every ``Premailer`` with those options."""
+    sheet = _cache_parse_css_string(css_body, validate=validate, parser=parser)
+    return _prepare_styles(sheet, strip_important, exclude_pseudoclasses, star)
+
 
+class _SubstitutingWriter(object):
+    """A binary file-like object that makes substitutions in what's written
+    to it before writing it to ``fileobj``. What might be the beginning of
+    a match is held back until the rest of it is written, or ``close()``.
+
+    The substitutions are ``(opening, regex, replacement)`` where
+    ``opening`` is what every match of ``regex`` starts with.
     """
-    return cssutils.parseString(css_body, validate=validate)
+
+    def __init__(self, fileobj, substitutions):
+        self.fileobj = fileobj
+        self.substitutions = substitutions
+        self.pending = b""
+
+    def write(self, data):
+        self.pending += data
+        safe = self._safe_length()
+        if safe:
+            self._write(self.pending[:safe])
+            self.pending = self.pending[safe:]
+        return len(data)
+
+    def close(self):
+        self._write(self.pending)
+        self.pending = b""
+
+    def _write(self, data):
+        for opening, regex, replacement in self.substitutions:
+            data = regex.sub(replacement, data)
+        if data:
+            self.fileobj.write(data)
+
+    def _safe_length(self):
+        data = self.pending
+        safe = len(data)
+        spans = []
+        for opening, regex, replacement in self.substitutions:
+            end = 0
+            for match in regex.finditer(data):
+                spans.append(match.span())
+                end = match.end()
+            start = data.find(opening, end)
+            if start == -1:
+                # The end might be the first part of an opening.
+                start = max(end, len(data) - len(opening) + 1)
+            safe = min(safe, start)
+        # Matches of different substitutions might overlap.
+        for start, end in sorted(spans, reverse=True):
+            if start < safe < end:
+                safe = start
+        return safe
+
+
+class _TemplateTags(object):
+    """Replaces the template tags (``{{name}}``) of a document, or whatever
+    else ``pattern`` matches, with placeholders which parsing, inlining and
+    serializing leave alone. Afterwards the tags are put back, or the html
+    is split at them."""
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.prefix = "premailer-%s-" % uuid.uuid4().hex
+        self.tags = []
+        # Of the tags, if the html was bytes.
+        self.encoding = None
+
+    def protect(self, html):
+        """Returns the html, text or bytes, with the tags replaced. Any
+        number of them are replaced in one scan of it."""
+        tags = self.tags
+
+        if isinstance(html, str):
+
+            def placeholder(match):
+                tags.append(match.group())
+                return "%s%d-" % (self.prefix, len(tags) - 1)
+
+            return re.sub(self.pattern, placeholder, html)
+
+        prefix = self.prefix.encode("ascii")
+
+        def placeholder(match):
+            tags.append(match.group())
+            return b"%s%d-" % (prefix, len(tags) - 1)
+
+        return re.sub(self.pattern.encode("ascii"), placeholder, html)
+
+    def substitution(self, encoding):
+        """Returns the ``(opening, regex, replacement)`` substitution which
+        puts the tags back in the html serialized in ``encoding``."""
+        tags = [
+            (x if isinstance(x, str) else x.decode(self.encoding)).encode(
+                encoding, "xmlcharrefreplace"
+            )
+            for x in self.tags
+        ]
+        prefix = self.prefix.encode("ascii")
+        return (
+            prefix,
+            re.compile(re.escape(prefix) + rb"(\d+)-"),
+            lambda match: tags[int(match.group(1))],
+        )
+
+    def split(self, html):
+        """Returns the html between the placeholders and the tags they
+        stand for."""
+        parts = re.split(re.escape(self.prefix) + r"(\d+)-", html)
+        return parts[::2], [self.tags[int(x)] for x in parts[1::2]]
 
 
-@function_cache()
-def _create_cssselector(selector):
-    return CSSSelector(selector)
+class _CountingWriter(object):
+    """A binary file-like object that counts the bytes written through it
+    to ``fileobj`` in ``counts["bytes"]``."""
+
+    def __init__(self, fileobj, counts):
+        self.fileobj = fileobj
+        self.counts = counts
+        counts["bytes"] = 0
+
+    def write(self, data):
+        self.counts["bytes"] += len(data)
+        return self.fileobj.write(data)
 
 
 def capitalize_float_margin(css_body):
@@ -89,8 +527,27 @@ def capitalize_float_margin(css_body):
     return _lowercase_margin_float_rule.sub(_capitalize_property, css_body)
 
 
+def _float_value(style):
+    """The value of the float property in a style attribute, without any
+    ``!important``, like ``cssutils.parseStyle(style).float``."""
+    value = ""
+    for name, pair_value in csstext_to_pairs(style, validate=False):
+        if name == "float":
+            value = pair_value
+    if value.endswith(" !important"):
+        value = value[: -len(" !important")]
+    return value
+
+
 _element_selector_regex = re.compile(r"(^|\s)\w")
-_cdata_regex = re.compile(r"\<\!\[CDATA\[(.*?)\]\]\>", re.DOTALL)
+_cdata_regex = re.compile(rb"\<\!\[CDATA\[(.*?)\]\]\>", re.DOTALL)
+# Handlebars which are the whole value of an attribute.
+_handlebar_pattern = r'(?<==")\{\{.*?\}\}(?=")'
+_leading_whitespace = re.compile(rb"\s*")
+# A charset in a <meta> or the XML declaration.
+_charset_regex = re.compile(rb"<(?:meta|\?xml)\s[^>]*(?:charset|encoding)\s*=", re.I)
+_boms = (codecs.BOM_UTF8, codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)
+_template_tag_pattern = r"(?s)\{\{\{.*?\}\}\}|\{\{.*?\}\}"
 _lowercase_margin_float_rule = re.compile(
     r"""(?P<property>margin(-(top|bottom|left|right))?|float)
         :
@@ -107,6 +564,170 @@ _short_color_codes = re.compile(r"^#([0-9a-f])([0-9a-f])([0-9a-f])$", re.I)
 FILTER_PSEUDOSELECTORS = [":last-child", ":first-child", ":nth-child"]
 
 
+class CompiledRule(object):
+    """One ``(specificity, selector, bulk)`` rule as returned by
+    ``Premailer._parse_style_rules``, split into the selector that is
+    matched against the document and the pseudoclass (if any) that the
+    style is merged under.
+
+    The ``CSSSelector`` and the ``(name, value)`` pairs of the bulk are
+    only built when first needed, or up front with ``prepare()``.
+    """
+
+    __slots__ = (
+        "specificity",
+        "selector",
+        "pseudoclass",
+        "bulk",
+        "_cssselector",
+        "_pairs",
+    )
+
+    def __init__(self, specificity, selector, bulk):
+        self.specificity = specificity
+        pseudoclass = ""
+        if ":" in selector:
+            new_selector, pseudoclass = re.split(":", selector, 1)
+            pseudoclass = ":%s" % pseudoclass
+            # Keep filter-type selectors untouched.
+            if pseudoclass in FILTER_PSEUDOSELECTORS or pseudoclass.startswith(
+                ":nth-child"
+            ):
+                pseudoclass = ""
+            else:
+                selector = new_selector
+        assert selector
+        self.selector = selector
+        self.pseudoclass = pseudoclass
+        self.bulk = bulk
+        self._cssselector = None
+        self._pairs = None
+
+    @property
+    def cssselector(self):
+        if self._cssselector is None:
+            self._cssselector = _create_cssselector(self.selector)
+        return self._cssselector
+
+    @property
+    def pairs(self):
+        if self._pairs is None:
+            # The bulk was validated, if at all, with the rest of its
+            # stylesheet already.
+            self._pairs = tuple(csstext_to_pairs(self.bulk, validate=False))
+        return self._pairs
+
+    def prepare(self):
+        """Build the selector and the property pairs now rather than on
+        first use."""
+        self.cssselector
+        self.pairs
+
+
+class CompiledStylesheet(object):
+    """The ``external_styles`` and ``css_text`` of a ``Premailer`` instance,
+    loaded, parsed, sorted and prepared once so that they can be inlined
+    into any number of documents.
+
+    Create one with ``Premailer.compile()``::
+
+        stylesheet = Premailer(css_text=BRAND_CSS).compile()
+        for html in documents:
+            send(stylesheet.apply(html))
+
+    Note that external stylesheets are only loaded once, when compiling.
+    """
+
+    def __init__(self, premailer):
+        self.premailer = premailer
+        self.rules, self.leftover = premailer._parse_options_styles()
+        for rule in self.rules:
+            rule.prepare()
+        self._digest = None
+
+    def digest(self):
+        """Returns a digest of the rules, for the keys of a
+        ``ResultCache``."""
+        if self._digest is None:
+            self._digest = _texts_digest(
+                ["%s %s {%s}" % (x.specificity, x.selector, x.bulk) for x in self.rules]
+                + [x.leftover_text for x in self.leftover]
+            )
+        return self._digest
+
+    def apply(self, html=None, pretty_print=True, output="str", **kwargs):
+        """Same as ``Premailer.transform()`` but without loading or parsing
+        the ``external_styles`` and ``css_text`` again."""
+        if self.premailer.result_cache is not None:
+            return self.premailer._cached_transform(
+                html, pretty_print, kwargs, stylesheet=self, output=output
+            )
+        return self.premailer._transform(
+            html, pretty_print, kwargs, stylesheet=self, output=output
+        )
+
+    def apply_to(self, fileobj, html=None, pretty_print=True, **kwargs):
+        """Same as ``Premailer.transform_to()`` but without loading or
+        parsing the ``external_styles`` and ``css_text`` again."""
+        self.premailer._transform(
+            html, pretty_print, kwargs, stylesheet=self, fileobj=fileobj
+        )
+
+    async def aapply(
+        self,
+        html=None,
+        pretty_print=True,
+        client=None,
+        executor=None,
+        output="str",
+        **kwargs
+    ):
+        """Same as ``Premailer.atransform()`` but without loading or parsing
+        the ``external_styles`` and ``css_text`` again."""
+        return await self.premailer._atransform(
+            html, pretty_print, kwargs, client, executor, stylesheet=self, output=output
+        )
+
+    def compile_template(self, html=None, pretty_print=True, **kwargs):
+        """Same as ``Premailer.compile_template()`` but without loading or
+        parsing the ``external_styles`` and ``css_text`` again."""
+        return self.premailer._compile_template(
+            html, pretty_print, kwargs, stylesheet=self
+        )
+
+
+class CompiledTemplate(object):
+    """A template inlined once, to render for any number of recipients.
+
+    Create one with ``Premailer.compile_template()``::
+
+        template = Premailer(TEMPLATE, css_text=BRAND_CSS).compile_template()
+        for recipient in recipients:
+            send(template.render(first_name=recipient.first_name))
+
+    It's the html between the template tags, ``segments``, and the
+    ``tags`` (like ``{{first_name}}``), by ``names`` (like
+    ``"first_name"``), so that rendering is just joining them.
+    """
+
+    def __init__(self, segments, tags):
+        self.segments = tuple(segments)
+        self.tags = tuple(tags)
+        self.names = tuple(tag.strip("{}").strip() for tag in tags)
+
+    def render(self, values=(), **kwargs):
+        """Returns the html with the tags replaced by their value in
+        ``values`` (or ``kwargs``), as it is, so escape it if need be. The
+        tags with no value are left as they were."""
+        values = dict(values, **kwargs)
+        parts = [None] * (len(self.segments) + len(self.tags))
+        parts[::2] = self.segments
+        parts[1::2] = [
+            str(values.get(name, tag)) for name, tag in zip(self.names, self.tags)
+        ]
+        return "".join(parts)
+
+
 class Premailer(object):
 
     attribute_name = "data-premailer"
@@ -141,6 +762,14 @@ class Premailer(object):
         allow_insecure_ssl=False,
         allow_loading_external_files=False,
         session=None,
+        matching_engine="xpath",
+        css_parser="cssutils",
+        instrumentation=None,
+        stylesheet_cache=None,
+        max_concurrent_fetches=None,
+        fetch_timeout=None,
+        prune_unused_css=False,
+        result_cache=None,
     ):
         self.html = html
         self.base_url = base_url
@@ -187,17 +816,80 @@ class Premailer(object):
         self.allow_insecure_ssl = allow_insecure_ssl
         self.allow_loading_external_files = allow_loading_external_files
         self.session = session or requests
+        # A premailer.http_cache.StylesheetCache
+        self.stylesheet_cache = stylesheet_cache
+        # If more than 1, the external stylesheets of a document are all
+        # loaded at the same time, this many at most, instead of one by one.
+        self.max_concurrent_fetches = max_concurrent_fetches
+        # Seconds to wait for each http request, passed on to the session.
+        self.fetch_timeout = fetch_timeout
+        self.prune_unused_css = prune_unused_css
+        # A premailer.result_cache.ResultCache
+        self.result_cache = result_cache
+        if matching_engine not in MATCHING_ENGINES:
+            raise ValueError(
+                "Unsupported matching engine. Available options: %s"
+                % "/".join(MATCHING_ENGINES.keys())
+            )
+        self.matching_engine = matching_engine
+        if css_parser not in CSS_PARSERS:
+            raise ValueError(
+                "Unsupported CSS parser. Available options: %s"
+                % "/".join(CSS_PARSERS.keys())
+            )
+        self.css_parser = css_parser
+        if callable(instrumentation) and not isinstance(
+            instrumentation, Instrumentation
+        ):
+            instrumentation = Callback(instrumentation)
+        self.instrumentation = instrumentation
 
         if cssutils_logging_handler:
             cssutils.log.addHandler(cssutils_logging_handler)
         if cssutils_logging_level:
             cssutils.log.setLevel(cssutils_logging_level)
 
+    def _span(self, name, **data):
+        return span(self.instrumentation, name, **data)
+
     def _parse_css_string(self, css_body, validate=True):
         if self.cache_css_parsing:
-            return _cache_parse_css_string(css_body, validate=validate)
+            return _cache_parse_css_string(
+                css_body, validate=validate, parser=self.css_parser
+            )
+
+        return CSS_PARSERS[self.css_parser](css_body, validate=validate)
 
-        return cssutils.parseString(css_body, validate=validate)
+    def _parse_styles(self, css_body):
+        """Returns the ``_Styles`` of a stylesheet for the options of this
+        instance."""
+        if not css_body:
+            return _no_styles
+        validate = not self.disable_validation
+        options = (
+            self.strip_important,
+            self.exclude_pseudoclasses,
+            self.include_star_selectors,
+        )
+        with self._span("parse_css") as counts:
+            if not self.cache_css_parsing:
+                sheet = self._parse_css_string(css_body, validate=validate)
+                styles = _prepare_styles(sheet, *options)
+            elif isinstance(css_body, _FileText):
+                # No need to look it up by its text.
+                key = (validate, self.css_parser) + options
+                try:
+                    styles = css_body.parsed[key]
+                except KeyError:
+                    sheet = self._parse_css_string(css_body, validate=validate)
+                    styles = css_body.parsed[key] = _prepare_styles(sheet, *options)
+            else:
+                styles = _cache_parse_styles(
+                    css_body, validate, self.css_parser, *options
+                )
+            counts["rules"] = len(styles.rules)
+            counts["leftover"] = len(styles.leftover)
+        return styles
 
     def _parse_style_rules(self, css_body, ruleset_index):
         """Returns a list of rules to apply to this doc and a list of rules
@@ -206,157 +898,191 @@ class Premailer(object):
         for example: ((0, 1, 0, 0, 0), u'.makeblue', u'color:blue').
         The bulk of the rule should not end in a semicolon.
         """
+        styles = self._parse_styles(css_body)
+        return _index_rules(styles.rules, ruleset_index), list(styles.leftover)
 
-        def format_css_property(prop):
-            if self.strip_important or prop.priority != "important":
-                return "{0}:{1}".format(prop.name, prop.value)
-            else:
-                return "{0}:{1} !important".format(prop.name, prop.value)
+    def compile(self):
+        """Returns a ``CompiledStylesheet`` of the ``external_styles`` and
+        ``css_text`` for inlining into many documents."""
+        return CompiledStylesheet(self)
 
-        def join_css_properties(properties):
-            """Accepts a list of cssutils Property objects and returns
-            a semicolon delimitted string like 'color: red; font-size: 12px'
-            """
-            return ";".join(format_css_property(prop) for prop in properties)
+    def transform(self, html=None, pretty_print=True, output="str", **kwargs):
+        """change the html and return it with CSS turned into style
+        attributes.
 
-        leftover = []
-        rules = []
-        # empty string
-        if not css_body:
-            return rules, leftover
-        sheet = self._parse_css_string(css_body, validate=not self.disable_validation)
-        for rule in sheet:
-            # handle media rule
-            if rule.type == rule.MEDIA_RULE:
-                leftover.append(rule)
-                continue
-            # only proceed for things we recognize
-            if rule.type != rule.STYLE_RULE:
-                continue
+        The html can be a string or bytes, in which case lxml works out its
+        encoding (or it's UTF-8). With ``output="bytes"`` the html is
+        returned as lxml serialized it, in the ``encoding`` keyword argument
+        or else the encoding of the html if it was bytes, or UTF-8.
+        """
+        if self.result_cache is not None:
+            return self._cached_transform(html, pretty_print, kwargs, output=output)
+        return self._transform(html, pretty_print, kwargs, output=output)
 
-            # normal means it doesn't have "!important"
-            normal_properties = [
-                prop
-                for prop in rule.style.getProperties()
-                if prop.priority != "important"
-            ]
-            important_properties = [
-                prop
-                for prop in rule.style.getProperties()
-                if prop.priority == "important"
-            ]
-
-            # Create three strings that we can use to add to the `rules`
-            # list later as ready blocks of css.
-            bulk_normal = join_css_properties(normal_properties)
-            bulk_important = join_css_properties(important_properties)
-            bulk_all = join_css_properties(normal_properties + important_properties)
-
-            selectors = (
-                x.strip()
-                for x in rule.selectorText.split(",")
-                if x.strip() and not x.strip().startswith("@")
+    def _cached_transform(
+        self, html, pretty_print, kwargs, stylesheet=None, output="str"
+    ):
+        """Same as ``_transform()`` but returns the result from the
+        ``result_cache`` if the html, the options and the external
+        stylesheets are all the same as when it was stored."""
+        document_html = self._get_html(html)
+        if hasattr(document_html, "getroottree"):
+            return self._transform(
+                html, pretty_print, kwargs, stylesheet=stylesheet, output=output
             )
-            for selector in selectors:
-                if (
-                    ":" in selector
-                    and self.exclude_pseudoclasses
-                    and ":" + selector.split(":", 1)[1] not in FILTER_PSEUDOSELECTORS
-                ):
-                    # a pseudoclass
-                    leftover.append((selector, bulk_all))
-                    continue
-                elif "*" in selector and not self.include_star_selectors:
-                    continue
-                elif selector.startswith(":"):
-                    continue
+        key = self._result_key(document_html, pretty_print, kwargs, stylesheet, output)
+        result = self.result_cache.get(key)
+        if result is not None:
+            with self._fetch(result.urls) as load:
+                css_bodies = [load(url) for url in result.urls]
+            if _texts_digest(css_bodies) == result.stylesheets:
+                return result.html
+
+        document = self._parse_document(html, stylesheet)
+        urls = list(OrderedDict.fromkeys(document.urls))
+        with self._fetch(urls) as load:
+            css_bodies = [load(url) for url in urls]
+        out = self._transform(
+            None,
+            pretty_print,
+            kwargs,
+            stylesheet=stylesheet,
+            document=document,
+            loaded=dict(zip(urls, css_bodies)),
+            output=output,
+        )
+        self.result_cache.set(key, Result(urls, _texts_digest(css_bodies), out))
+        return out
+
+    def _result_key(self, html, pretty_print, kwargs, stylesheet, output):
+        """A digest of the html and everything else that goes into
+        transforming it, but the external stylesheets."""
+        options = [
+            type(self).__qualname__,
+            pretty_print,
+            output,
+            sorted(kwargs.items()),
+        ]
+        options.extend(getattr(self, name) for name in _RESULT_OPTIONS)
+        if stylesheet is not None:
+            options.append(stylesheet.digest())
+        return _texts_digest([repr(options), html])
+
+    def transform_to(self, fileobj, html=None, pretty_print=True, **kwargs):
+        """Same as ``transform()`` but writes the html to a binary file-like
+        object as it's serialized, instead of returning it as a string.
+        """
+        self._transform(html, pretty_print, kwargs, fileobj=fileobj)
 
-                # Crudely calculate specificity
-                id_count = selector.count("#")
-                class_count = selector.count(".")
-                element_count = len(_element_selector_regex.findall(selector))
-
-                # Within one rule individual properties have different
-                # priority depending on !important.
-                # So we split each rule into two: one that includes all
-                # the !important declarations and another that doesn't.
-                for is_important, bulk in ((1, bulk_important), (0, bulk_normal)):
-                    if not bulk:
-                        # don't bother adding empty css rules
-                        continue
-                    specificity = (
-                        is_important,
-                        id_count,
-                        class_count,
-                        element_count,
-                        ruleset_index,
-                        len(rules),  # this is the rule's index number
-                    )
-                    rules.append((specificity, selector, bulk))
+    def compile_template(self, html=None, pretty_print=True, **kwargs):
+        """Inlines a template once and returns a ``CompiledTemplate`` to
+        render for each recipient. The template tags, like ``{{name}}``,
+        are kept as they are wherever they are, in text and in attributes.
+        """
+        return self._compile_template(html, pretty_print, kwargs)
 
-        return rules, leftover
+    def _compile_template(self, html, pretty_print, kwargs, stylesheet=None):
+        template = _TemplateTags(_template_tag_pattern)
+        html = self._transform(
+            html, pretty_print, kwargs, stylesheet=stylesheet, template=template
+        )
+        return CompiledTemplate(*template.split(html))
 
-    def transform(self, html=None, pretty_print=True, **kwargs):
-        """change the html and return it with CSS turned into style
-        attributes.
+    async def atransform(
+        self,
+        html=None,
+        pretty_print=True,
+        client=None,
+        executor=None,
+        output="str",
+        **kwargs
+    ):
+        """Same as ``transform()`` but without blocking the event loop.
+
+        The external stylesheets are all loaded at the same time with
+        ``client`` (see ``premailer.aio``), by default with the ``session``
+        in the ``executor``. Parsing and inlining are done in the
+        ``executor``, the event loop's default one unless given. With a
+        ``result_cache`` the stylesheets are loaded the same way to check
+        that a stored result is still the same.
         """
-        if html is not None and self.html is not None:
-            raise TypeError("Can't pass html argument twice")
-        elif html is None and self.html is None:
-            raise TypeError("must pass html as first argument")
-        elif html is None:
-            html = self.html
-        if hasattr(html, "getroottree"):
-            # skip the next bit
-            root = html.getroottree()
-            page = root
-            tree = root
-        else:
-            if self.method == "xml":
-                parser = etree.XMLParser(ns_clean=False, resolve_entities=False)
-            else:
-                parser = etree.HTMLParser()
-            stripped = html.strip()
-
-            # Escape all characters in handlebars in HTML attributes.
-            # Without this step, if handlebars were to include a character such as ",
-            # etree.fromstring() would not be able to differentiate the "'s in the value
-            # from the "'s for the attribute.
-            # --------------------------------------------------------------------------
-            # Provided the input below:
-            # <a href="{{ "<Test>" }}"></a>
-            # --------------------------------------------------------------------------
-            # Decoded result without preservation:
-            # <a href="%7B%7B%20">" }}"&gt;</a>
-            # Everything between the first two quotes were treated as the value of the
-            # attribute. Then, the characters between the second quote and the second
-            # > were treated as invalid attributes and discarded. Lastly, the value of
-            # the original attribute after the second and </a> were treated as the
-            # contents of the HTML tag.
-            # ---
-            # Result:
-            # <a href="%7B%7B%20">" }}"&gt;</a>
-            # --------------------------------------------------------------------------
-            # Decoded result with preservation (prior to unescape() & unquote()):
-            # <a href="%7B%7B%20%22&lt;Test&gt;%22%20%7D%7D"></a>
-            # No value was lost in the encoding process.
-            # ---
-            # Result after unquote() and unescape():
-            # <a href="{{ "<Test>" }}"></a>
-            if self.preserve_handlebar_syntax:
-                stripped = re.sub(
-                    r'="{{(.*?)}}"',
-                    lambda match: '="{{' + escape(match.groups()[0]) + '}}"',
-                    stripped,
-                )
+        return await self._atransform(
+            html, pretty_print, kwargs, client, executor, output=output
+        )
 
-            tree = etree.fromstring(stripped, parser).getroottree()
-            page = tree.getroot()
-            # lxml inserts a doctype if none exists, so only include it in
-            # the root if it was in the original html.
-            root = tree if stripped.startswith(tree.docinfo.doctype) else page
+    async def _atransform(
+        self,
+        html,
+        pretty_print,
+        kwargs,
+        client,
+        executor,
+        stylesheet=None,
+        output="str",
+    ):
+        loop = asyncio.get_event_loop()
+        if client is None:
+            client = ExecutorClient(self.session, executor)
+        key = None
+        if self.result_cache is not None:
+            document_html = self._get_html(html)
+            if not hasattr(document_html, "getroottree"):
+                key = self._result_key(
+                    document_html, pretty_print, kwargs, stylesheet, output
+                )
+                result = self.result_cache.get(key)
+                if result is not None:
+                    css_bodies = await self._aload_all(result.urls, client, executor)
+                    if _texts_digest(css_bodies) == result.stylesheets:
+                        return result.html
+
+        document = await loop.run_in_executor(
+            executor, self._parse_document, html, stylesheet
+        )
+        urls = list(OrderedDict.fromkeys(document.urls))
+        css_bodies = await self._aload_all(urls, client, executor)
+        out = await loop.run_in_executor(
+            executor,
+            functools.partial(
+                self._transform,
+                None,
+                pretty_print,
+                kwargs,
+                stylesheet=stylesheet,
+                document=document,
+                loaded=dict(zip(urls, css_bodies)),
+                output=output,
+            ),
+        )
+        if key is not None:
+            self.result_cache.set(key, Result(urls, _texts_digest(css_bodies), out))
+        return out
+
+    async def _aload_all(self, urls, client, executor):
+        """Loads all the external stylesheets at the same time, but no more
+        than ``max_concurrent_fetches`` at once."""
+        semaphore = asyncio.Semaphore(self.max_concurrent_fetches or len(urls) or 1)
+        return await asyncio.gather(
+            *(self._aload_external(url, client, executor, semaphore) for url in urls)
+        )
 
-        assert page is not None
+    def _transform(
+        self,
+        html,
+        pretty_print,
+        kwargs,
+        stylesheet=None,
+        fileobj=None,
+        document=None,
+        loaded=None,
+        template=None,
+        output="str",
+    ):
+        if output not in ("str", "bytes"):
+            raise ValueError("Unsupported output. Available options: str/bytes")
+        if document is None:
+            document = self._parse_document(html, stylesheet, template)
+        root, page, tree, elements, urls, encoding, handlebars = document
 
         if self.disable_leftover_css:
             head = None
@@ -368,170 +1094,179 @@ class Premailer(object):
 
         rules = []
         index = 0
+        to_prune = []
 
-        cssselector = ["style"]
-        if self.allow_network:
-            cssselector.append("link[rel~=stylesheet]")
-        for element in _create_cssselector(",".join(cssselector))(page):
-            # If we have a media attribute whose value is anything other than
-            # 'all' or 'screen', ignore the ruleset.
-            media = element.attrib.get("media")
-            if media and media not in ("all", "screen"):
-                continue
-
-            data_attribute = element.attrib.get(self.attribute_name)
-            if data_attribute:
-                if data_attribute == "ignore":
-                    del element.attrib[self.attribute_name]
-                    continue
-                else:
-                    warnings.warn(
-                        "Unrecognized %s attribute (%r)"
-                        % (self.attribute_name, data_attribute)
-                    )
-
-            is_style = element.tag == "style"
-            if is_style:
-                css_body = element.text
-            else:
+        with self._fetch(urls, loaded) as load:
+            for element in elements:
+                is_style = element.tag == "style"
                 href = element.attrib.get("href")
-                css_body = self._load_external(href)
-
-            these_rules, these_leftover = self._parse_style_rules(css_body, index)
-
-            index += 1
-            rules.extend(these_rules)
-            parent_of_element = element.getparent()
-            if these_leftover or self.keep_style_tags:
-                if is_style:
-                    style = element
-                else:
-                    style = etree.Element("style")
-                    style.attrib["type"] = "text/css"
-                if self.keep_style_tags:
-                    style.text = css_body
-                else:
-                    style.text = self._css_rules_to_string(these_leftover)
-
-                if self.strip_important:
-                    style.text = _importants.sub("", style.text)
-
-                if self.method == "xml":
-                    style.text = etree.CDATA(style.text)
-
-                if not is_style:
-                    element.addprevious(style)
-                    parent_of_element.remove(element)
+                with self._span("stylesheet", tag=element.tag, href=href):
+                    if is_style:
+                        css_body = element.text
+                    else:
+                        css_body = load(href)
 
-            elif not self.keep_style_tags or not is_style:
-                parent_of_element.remove(element)
+                    styles = self._parse_styles(css_body)
 
-        # external style files
-        if self.external_styles and self.allow_network:
-            for stylefile in self.external_styles:
-                css_body = self._load_external(stylefile)
-                self._process_css_text(css_body, index, rules, head)
-                index += 1
-
-        # css text
-        if self.css_text:
-            for css_body in self.css_text:
-                self._process_css_text(css_body, index, rules, head)
+                these_rules = _index_rules(styles.rules, (0, index))
+                rules.extend(CompiledRule(*rule) for rule in these_rules)
                 index += 1
+                parent_of_element = element.getparent()
+                if styles.leftover or self.keep_style_tags:
+                    if is_style:
+                        style = element
+                    else:
+                        style = etree.Element("style")
+                        style.attrib["type"] = "text/css"
+                    if self.keep_style_tags:
+                        self._set_style_text(style, css_body)
+                    elif self.prune_unused_css:
+                        # Done below, for all the stylesheets at once.
+                        to_prune.append((style, styles.leftover))
+                    else:
+                        self._set_style_text(style, styles.leftover_text)
+
+                    if not is_style:
+                        element.addprevious(style)
+                        parent_of_element.remove(element)
+
+                elif not self.keep_style_tags or not is_style:
+                    parent_of_element.remove(element)
 
-        # rules is a tuple of (specificity, selector, styles), where
-        # specificity is a tuple ordered such that more specific
-        # rules sort larger.
-        rules.sort(key=operator.itemgetter(0))
-
-        # collecting all elements that we need to apply rules on
-        # id is unique for the lifetime of the object
-        # and lxml should give us the same everytime during this run
-        # item id -> {item: item, classes: [], style: []}
-        elements = {}
-        for _, selector, style in rules:
-            new_selector = selector
-            class_ = ""
-            if ":" in selector:
-                new_selector, class_ = re.split(":", selector, 1)
-                class_ = ":%s" % class_
-            # Keep filter-type selectors untouched.
-            if class_ in FILTER_PSEUDOSELECTORS or class_.startswith(":nth-child"):
-                class_ = ""
+            if stylesheet is None:
+                options_rules, options_leftover = self._parse_options_styles(load)
             else:
-                selector = new_selector
-
-            assert selector
-            sel = _create_cssselector(selector)
-            items = sel(page)
-            if len(items):
-                # same so process it first
-                processed_style = csstext_to_pairs(
-                    style, validate=not self.disable_validation
+                options_rules = stylesheet.rules
+                options_leftover = stylesheet.leftover
+        if head is None:
+            options_leftover = []
+        if self.prune_unused_css and not self.keep_style_tags:
+            pruned = iter(
+                self._prune_unused_css(
+                    page,
+                    [x[1] for x in to_prune] + [x.leftover for x in options_leftover],
                 )
+            )
+            for style, _ in to_prune:
+                leftover = next(pruned)
+                if leftover:
+                    self._set_style_text(style, _css_rules_to_string(leftover))
+                else:
+                    style.getparent().remove(style)
+            options_leftover = [_css_rules_to_string(x) for x in pruned if x]
+        else:
+            options_leftover = [x.leftover_text for x in options_leftover]
+        for css_body in options_leftover:
+            style = etree.Element("style")
+            style.attrib["type"] = "text/css"
+            style.text = css_body
+            head.append(style)
 
-                for item in items:
-                    item_id = id(item)
-                    if item_id not in elements:
-                        elements[item_id] = {"item": item, "classes": [], "style": []}
+        # Every rule has a specificity tuple ordered such that more
+        # specific rules sort larger. The options rules come sorted already
+        # so unless the document has rules of its own there's nothing to do.
+        if rules:
+            rules.extend(options_rules)
+            rules.sort(key=operator.attrgetter("specificity"))
+        else:
+            rules = options_rules
 
-                    elements[item_id]["style"].append(processed_style)
-                    elements[item_id]["classes"].append(class_)
+        # collecting all elements that we need to apply rules on
+        # and the rules that apply to each of them
+        with self._span(
+            "match", engine=self.matching_engine, rules=len(rules)
+        ) as counts:
+            possible = possible_rules(page, rules)
+            counts["skipped"] = len(rules) - len(possible)
+            elements = MATCHING_ENGINES[self.matching_engine](
+                page, possible, self.instrumentation
+            )
+            counts["elements"] = len(elements)
 
         # Now apply inline style
         # merge style only once for each element
         # crucial when you have a lot of pseudo/classes
         # and a long list of elements
-        for _, element in elements.items():
-            final_style = merge_styles(
-                element["item"].attrib.get("style", ""),
-                element["style"],
-                element["classes"],
-                remove_unset_properties=self.remove_unset_properties,
-            )
-            if final_style:
-                # final style could be empty string because of
-                # remove_unset_properties
-                element["item"].attrib["style"] = final_style
-            self._style_to_basic_html_attributes(
-                element["item"], final_style, force=True
-            )
-
-        if self.remove_classes:
-            # now we can delete all 'class' attributes
-            for item in page.xpath("//@class"):
-                parent = item.getparent()
-                del parent.attrib["class"]
-
-        # Capitalize Margin properties
-        # To fix weird outlook bug
-        # https://www.emailonacid.com/blog/article/email-development/outlook.com-does-support-margins
-        if self.capitalize_float_margin:
-            for item in page.xpath("//@style"):
-                mangled = capitalize_float_margin(item)
-                item.getparent().attrib["style"] = mangled
-
-        # Add align attributes to images if they have a CSS float value of
-        # right or left. Outlook (both on desktop and on the web) are bad at
-        # understanding floats, but they do understand the HTML align attrib.
-        if self.align_floating_images:
-            for item in page.xpath("//img[@style]"):
-                image_css = cssutils.parseStyle(item.attrib["style"])
-                if image_css.float == "right":
-                    item.attrib["align"] = "right"
-                elif image_css.float == "left":
-                    item.attrib["align"] = "left"
+        final_styles = []
+        with self._span("merge", elements=len(elements)):
+            for item, item_rules in elements:
+                styles = StyleAccumulator()
+                for rule in item_rules:
+                    styles.add(rule.pairs, rule.pseudoclass)
+                final_style = styles.to_string(
+                    item.attrib.get("style", ""),
+                    remove_unset_properties=self.remove_unset_properties,
+                )
+                if final_style:
+                    # final style could be empty string because of
+                    # remove_unset_properties
+                    item.attrib["style"] = final_style
+                final_styles.append((item, final_style))
+        with self._span("basic_attributes", elements=len(final_styles)):
+            for item, final_style in final_styles:
+                self._style_to_basic_html_attributes(item, final_style, force=True)
 
-        #
-        # URLs
-        #
         if self.base_url and not self.disable_link_rewrites:
             if not urlparse(self.base_url).scheme:
                 raise ValueError("Base URL must have a scheme")
-            for attr in ("href", "src"):
-                for item in page.xpath("//@%s" % attr):
-                    parent = item.getparent()
-                    url = parent.attrib[attr]
+        with self._span("post_process") as counts:
+            self._post_process(page, template, handlebars, counts)
+
+        if hasattr(html, "getroottree") and fileobj is None:
+            return root
+        else:
+            kwargs.setdefault("method", self.method)
+            kwargs.setdefault("pretty_print", pretty_print)
+            # As Ken Thompson intended, unless the html was in another one.
+            kwargs.setdefault("encoding", encoding or "utf-8")
+            with self._span("serialize") as counts:
+                return self._serialize(
+                    root, fileobj, kwargs, counts, output, handlebars
+                )
+
+    def _post_process(self, page, template, handlebars, counts):
+        """Does what's left to do to each element after inlining, in one
+        walk over the document."""
+        rewrite_urls = bool(self.base_url and not self.disable_link_rewrites)
+        if not (
+            self.remove_classes
+            or self.capitalize_float_margin
+            or self.align_floating_images
+            or rewrite_urls
+        ):
+            counts["elements"] = 0
+            return
+        placeholders = tuple(x.prefix for x in (template, handlebars) if x is not None)
+        elements = 0
+        for item in page.iter(etree.Element):
+            elements += 1
+            attrib = item.attrib
+            if self.remove_classes and "class" in attrib:
+                del attrib["class"]
+
+            style = attrib.get("style")
+            # Capitalize Margin properties
+            # To fix weird outlook bug
+            # https://www.emailonacid.com/blog/article/email-development/outlook.com-does-support-margins
+            if self.capitalize_float_margin and style is not None:
+                style = attrib["style"] = capitalize_float_margin(style)
+
+            # Add align attributes to images if they have a CSS float value of
+            # right or left. Outlook (both on desktop and on the web) are bad at
+            # understanding floats, but they do understand the HTML align attrib.
+            if self.align_floating_images and style and item.tag == "img":
+                float_ = _float_value(style)
+                if float_ in ("right", "left"):
+                    attrib["align"] = float_
+
+            #
+            # URLs
+            #
+            if rewrite_urls:
+                for attr in ("href", "src"):
+                    url = attrib.get(attr)
+                    if url is None:
+                        continue
                     if (
                         attr == "href"
                         and self.preserve_internal_links
@@ -546,36 +1281,233 @@ class Premailer(object):
                         continue
                     if attr == "href" and url.startswith("tel:"):
                         continue
-                    parent.attrib[attr] = urljoin(self.base_url, url)
+                    if url.startswith(placeholders):
+                        # The url is a template tag or handlebars.
+                        continue
+                    attrib[attr] = urljoin(self.base_url, url)
+        counts["elements"] = elements
 
+    def _get_html(self, html):
+        if html is not None and self.html is not None:
+            raise TypeError("Can't pass html argument twice")
+        elif html is None and self.html is None:
+            raise TypeError("must pass html as first argument")
+        elif html is None:
+            html = self.html
+        return html
+
+    def _parse_document(self, html, stylesheet=None, template=None):
+        """Parses the html, with the tags of the ``_TemplateTags``
+        ``template`` replaced if given, and finds the stylesheets in it,
+        and the urls of all the external ones to load."""
+        html = self._get_html(html)
+        encoding = None
+        handlebars = None
         if hasattr(html, "getroottree"):
-            return root
+            if template is not None:
+                raise TypeError("A template must be a string")
+            # skip the next bit
+            root = html.getroottree()
+            page = root
+            tree = root
         else:
-            kwargs.setdefault("method", self.method)
-            kwargs.setdefault("pretty_print", pretty_print)
-            kwargs.setdefault("encoding", "utf-8")  # As Ken Thompson intended
-            out = etree.tostring(root, **kwargs).decode(kwargs["encoding"])
+            is_text = isinstance(html, str)
+            if template is not None and not is_text:
+                raise TypeError("A template must be a string")
             if self.method == "xml":
-                out = _cdata_regex.sub(
-                    lambda m: "/*<![CDATA[*/%s/*]]>*/" % m.group(1), out
-                )
-            # Replace %xx escapes and HTML entities, within handlebars in HTML
-            # attributes, with their single-character equivalents.
+                parser = etree.XMLParser(ns_clean=False, resolve_entities=False)
+            elif is_text or _declares_encoding(html):
+                parser = etree.HTMLParser()
+            else:
+                # Rather than the HTML 4 default of ISO-8859-1.
+                parser = etree.HTMLParser(encoding="utf-8")
+            # Bytes are parsed as they are, without copying them.
+            stripped = html.strip() if is_text else html
+            if template is not None:
+                stripped = template.protect(stripped)
+
+            # Replace the handlebars in HTML attributes, whatever they contain,
+            # with placeholders that lxml doesn't escape. If they were to
+            # include a character such as ", etree.fromstring() would not be
+            # able to tell the "'s in the value from the "'s of the attribute:
+            # <a href="{{ "<Test>" }}"></a>
+            # would become
+            # <a href="%7B%7B%20">" }}"&gt;</a>
+            # They're put back as they were when the html is serialized.
             if self.preserve_handlebar_syntax:
-                out = re.sub(
-                    r'="%7B%7B(.+?)%7D%7D"',
-                    lambda match: '="{{' + unescape(unquote(match.groups()[0])) + '}}"',
-                    out,
-                )
+                handlebars = _TemplateTags(_handlebar_pattern)
+                stripped = handlebars.protect(stripped)
+
+            with self._span("parse_html", bytes=len(stripped)):
+                tree = etree.fromstring(stripped, parser).getroottree()
+            page = tree.getroot()
+            # lxml inserts a doctype if none exists, so only include it in
+            # the root if it was in the original html.
+            doctype = tree.docinfo.doctype
+            if not is_text:
+                encoding = tree.docinfo.encoding
+                if handlebars is not None:
+                    handlebars.encoding = encoding
+                start = _leading_whitespace.match(stripped).end()
+                end = start + len(doctype)
+                stripped = bytes(stripped[start:end])
+                doctype = doctype.encode("ascii", "replace")
+            root = tree if stripped.startswith(doctype) else page
+
+        assert page is not None
+
+        cssselector = ["style"]
+        if self.allow_network:
+            cssselector.append("link[rel~=stylesheet]")
+        elements = []
+        for element in _create_cssselector(",".join(cssselector))(page):
+            # If we have a media attribute whose value is anything other than
+            # 'all' or 'screen', ignore the ruleset.
+            media = element.attrib.get("media")
+            if media and media not in ("all", "screen"):
+                continue
+
+            data_attribute = element.attrib.get(self.attribute_name)
+            if data_attribute:
+                if data_attribute == "ignore":
+                    del element.attrib[self.attribute_name]
+                    continue
+                else:
+                    warnings.warn(
+                        "Unrecognized %s attribute (%r)"
+                        % (self.attribute_name, data_attribute)
+                    )
+            elements.append(element)
+
+        urls = [
+            element.attrib.get("href") for element in elements if element.tag != "style"
+        ]
+        if stylesheet is None and self.external_styles and self.allow_network:
+            urls.extend(self.external_styles)
+        return _Document(root, page, tree, elements, urls, encoding, handlebars)
+
+    def _serialize(self, root, fileobj, kwargs, counts, output="str", handlebars=None):
+        substitutions = self._output_substitutions(kwargs["encoding"], handlebars)
+        if fileobj is not None:
+            if self.instrumentation is not None:
+                fileobj = _CountingWriter(fileobj, counts)
+            if substitutions:
+                fileobj = _SubstitutingWriter(fileobj, substitutions)
+            if hasattr(root, "write"):
+                root.write(fileobj, **kwargs)
+            else:
+                # Unlike the whole tree, just the element without the
+                # doctype.
+                with etree.xmlfile(fileobj, encoding=kwargs.pop("encoding")) as f:
+                    f.write(root, **kwargs)
+            if substitutions:
+                fileobj.close()
+            return
+        out = etree.tostring(root, **kwargs)
+        for opening, regex, replacement in substitutions:
+            out = regex.sub(replacement, out)
+        counts["bytes"] = len(out)
+        if output == "bytes":
             return out
+        return out.decode(kwargs["encoding"])
+
+    def _output_substitutions(self, encoding, handlebars=None):
+        """Returns the substitutions to make in the serialized html as
+        ``(opening, regex, replacement)``."""
+        substitutions = []
+        if self.method == "xml":
+            substitutions.append(
+                (
+                    b"<![CDATA[",
+                    _cdata_regex,
+                    lambda m: b"/*<![CDATA[*/%s/*]]>*/" % m.group(1),
+                )
+            )
+        # Put the handlebars in HTML attributes back as they were.
+        if handlebars is not None and handlebars.tags:
+            substitutions.append(handlebars.substitution(encoding))
+        return substitutions
 
     def _load_external_url(self, url):
-        response = self.session.get(url, verify=not self.allow_insecure_ssl)
+        if self.stylesheet_cache is not None:
+            return self.stylesheet_cache.load(url, self._get)
+        response = self._get(url)
         response.raise_for_status()
         return response.text
 
+    def _get(self, url, headers=None):
+        kwargs = {}
+        if headers:
+            kwargs["headers"] = headers
+        if self.fetch_timeout is not None:
+            kwargs["timeout"] = self.fetch_timeout
+        return self.session.get(url, verify=not self.allow_insecure_ssl, **kwargs)
+
+    def _load(self, url):
+        with self._span("load", url=url):
+            return self._load_external(url)
+
+    @contextlib.contextmanager
+    def _fetch(self, urls, loaded=None):
+        """Gives a function which returns the stylesheet of any of the
+        ``urls``. With ``max_concurrent_fetches`` they're all started being
+        loaded in threads first, and the function waits for the one asked
+        for, so the stylesheets are still processed in the same order.
+        If they're ``loaded`` already, it's looked up in that dictionary.
+        """
+        if loaded is not None:
+            yield loaded.__getitem__
+            return
+        if not urls or (self.max_concurrent_fetches or 1) < 2:
+            yield self._load
+            return
+        futures = {}
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(self.max_concurrent_fetches, len(urls) or 1)
+        )
+        try:
+            for url in urls:
+                if url not in futures:
+                    futures[url] = executor.submit(self._load, url)
+            yield lambda url: futures[url].result()
+        finally:
+            # Nothing still waiting is needed if something went wrong.
+            for future in futures.values():
+                future.cancel()
+            executor.shutdown(wait=False)
+
     def _load_external(self, url):
         """loads an external stylesheet from a remote url or local path"""
+        location = self._external_location(url)
+        if _is_url(location):
+            return self._load_external_url(location)
+        return _read_file(location)
+
+    async def _aload_external(self, url, client, executor, semaphore):
+        location = self._external_location(url)
+        async with semaphore:
+            if not _is_url(location):
+                loop = asyncio.get_event_loop()
+                return await loop.run_in_executor(
+                    executor, self._load_external, location
+                )
+
+            async def get(url, headers=None):
+                return await client.get(
+                    url,
+                    headers=headers,
+                    verify=not self.allow_insecure_ssl,
+                    timeout=self.fetch_timeout,
+                )
+
+            if self.stylesheet_cache is not None:
+                return await self.stylesheet_cache.aload(location, get)
+            response = await get(location)
+            response.raise_for_status()
+            return response.text
+
+    def _external_location(self, url):
+        """Returns the absolute url or path of an external stylesheet."""
         if url.startswith("//"):
             # then we have to rely on the base_url
             if self.base_url and "https://" in self.base_url:
@@ -583,8 +1515,8 @@ class Premailer(object):
             else:
                 url = "http:" + url
 
-        if url.startswith("http://") or url.startswith("https://"):
-            css_body = self._load_external_url(url)
+        if _is_url(url):
+            return url
         elif not self.allow_loading_external_files:
             raise ExternalFileLoadingError(
                 "Unable to load external file {!r} because it's explicitly not allowed"
@@ -596,16 +1528,13 @@ class Premailer(object):
             if not os.path.isabs(stylefile):
                 stylefile = os.path.abspath(os.path.join(base_path, stylefile))
             if os.path.exists(stylefile):
-                with codecs.open(stylefile, encoding="utf-8") as f:
-                    css_body = f.read()
+                return stylefile
             elif self.base_url:
                 url = urljoin(self.base_url, url)
-                return self._load_external(url)
+                return self._external_location(url)
             else:
                 raise ExternalNotFoundError(stylefile)
 
-        return css_body
-
     @staticmethod
     def six_color(color_value):
         """Fix background colors for Lotus Notes
@@ -662,51 +1591,119 @@ class Premailer(object):
                 continue
             element.attrib[key] = value
 
-    def _css_rules_to_string(self, rules):
-        """given a list of css rules returns a css string"""
-        lines = []
-        for item in rules:
-            if isinstance(item, tuple):
-                k, v = item
-                lines.append("%s {%s}" % (k, make_important(v)))
-            # media rule
-            else:
-                for rule in item.cssRules:
-                    if isinstance(
-                        rule,
-                        (
-                            cssutils.css.csscomment.CSSComment,
-                            cssutils.css.cssunknownrule.CSSUnknownRule,
-                        ),
-                    ):
-                        continue
-                    for key in rule.style.keys():
-                        rule.style[key] = (
-                            rule.style.getPropertyValue(key, False),
-                            "!important",
-                        )
-                lines.append(item.cssText)
-        return "\n".join(lines)
-
-    def _process_css_text(self, css_text, index, rules, head):
-        """processes the given css_text by adding rules that can be
-        in-lined to the given rules list and adding any that cannot
-        be in-lined to the given `<head>` element.
+    def _set_style_text(self, style, css_body):
+        if self.strip_important:
+            css_body = _importants.sub("", css_body)
+        if self.method == "xml":
+            css_body = etree.CDATA(css_body)
+        style.text = css_body
+
+    def _prune_unused_css(self, page, leftovers):
+        """Returns the rules of each of ``leftovers``, the ``leftover`` of
+        ``_Styles``, without the selectors that don't apply to any element
+        of the document in any state."""
+        stripped = {}
+        for rules in leftovers:
+            for selector in _leftover_selectors(rules):
+                stripped[selector] = _without_pseudo(selector)
+        if not stripped:
+            return leftovers
+        with self._span("prune", selectors=len(stripped)) as counts:
+            in_use = selectors_in_use(
+                page,
+                set(filter(None, stripped.values())),
+                self.matching_engine,
+                self.instrumentation,
+            )
+
+            def is_used(selector):
+                # Those like ":hover" on their own apply to anything.
+                return not stripped[selector] or stripped[selector] in in_use
+
+            counts["unused"] = len(stripped) - sum(map(is_used, stripped))
+            return [_prune_rules(rules, is_used) for rules in leftovers]
+
+    def _parse_options_styles(self, load=None):
+        """Loads, with ``load(url)`` if given, and parses the
+        ``external_styles`` and ``css_text``.
+
+        Returns a list of ``CompiledRule`` sorted by specificity and a list
+        of the ``_Styles`` with rules that can't be in-lined, whose
+        ``leftover_text`` is put in ``<style>`` tags in the ``<head>`` (or,
+        with ``keep_style_tags``, the whole stylesheet is).
         """
-        these_rules, these_leftover = self._parse_style_rules(css_text, index)
-        rules.extend(these_rules)
-        if head is not None and (these_leftover or self.keep_style_tags):
-            style = etree.Element("style")
-            style.attrib["type"] = "text/css"
-            if self.keep_style_tags:
-                style.text = css_text
+        css_bodies = []
+        if self.external_styles and self.allow_network:
+            if load is None:
+                with self._fetch(self.external_styles) as load:
+                    css_bodies.extend(map(load, self.external_styles))
             else:
-                style.text = self._css_rules_to_string(these_leftover)
-            head.append(style)
+                css_bodies.extend(map(load, self.external_styles))
+        if self.css_text:
+            css_bodies.extend(self.css_text)
+
+        rules = []
+        leftover = []
+        for index, css_body in enumerate(css_bodies):
+            # These are always applied after the document's own
+            # stylesheets, whatever the number of those.
+            styles = self._parse_styles(css_body)
+            these_rules = _index_rules(styles.rules, (1, index))
+            rules.extend(CompiledRule(*rule) for rule in these_rules)
+            if self.keep_style_tags:
+                leftover.append(styles._replace(leftover_text=css_body))
+            elif styles.leftover:
+                leftover.append(styles)
+        rules.sort(key=operator.attrgetter("specificity"))
+        return rules, leftover
+
+
+def transform(html, pretty_print=False, output="str", **kwargs):
+    return Premailer(**kwargs).transform(html, pretty_print=pretty_print, output=output)
+
+
+# The pickled options and the compiled stylesheet of a transform_many()
+# worker process.
+_worker = None
 
 
-def transform(html, pretty_print=False, **kwargs):
-    return Premailer(**kwargs).transform(html, pretty_print=pretty_print)
+def _transform_in_worker(options, pretty_print, html):
+    global _worker
+    if _worker is None or _worker[0] != options:
+        _worker = (options, Premailer(**pickle.loads(options)).compile())
+    return _worker[1].apply(html, pretty_print=pretty_print)
+
+
+def transform_many(
+    htmls, workers=None, ordered=True, chunksize=1, pretty_print=False, **kwargs
+):
+    """Transforms many HTML documents with the same options using a pool of
+    ``workers`` processes (defaults to the number of CPUs).
+
+    Every process creates its ``Premailer`` once, and compiles its
+    ``external_styles`` and ``css_text`` once, when it gets its first
+    document, so the options (and any ``session``) must be picklable.
+
+    Returns a list of the transformed documents in the same order as
+    ``htmls``, or if ``ordered`` is false, a generator of
+    ``(index, transformed)`` tuples in the order they are done.
+    """
+    job = functools.partial(_transform_in_worker, pickle.dumps(kwargs), pretty_print)
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    if ordered:
+        with executor:
+            return list(executor.map(job, htmls, chunksize=chunksize))
+
+    def as_completed():
+        with executor:
+            futures = {
+                executor.submit(job, html): index
+                for index, html in enumerate(htmls)
+            }
+            for future in concurrent.futures.as_completed(futures):
+                yield futures[future], future.result()
+
+    return as_completed()
 
 
 if __name__ == "__main__":  # pragma: no cover
@@ -0,0 +1,52 @@
+"""A cache of the html that ``Premailer.transform()`` returns, for when the
+same documents are transformed again and again::
+
+    result_cache = ResultCache(maxbytes=50 * 1024 * 1024)
+    for html in documents:
+        Premailer(html, result_cache=result_cache).transform()
+
+Results are stored by a digest of the html and of the options. They're used
+for as long as the external stylesheets that went into them are the same,
+which means loading those again (so do use a ``stylesheet_cache`` too).
+"""
+import threading
+from collections import namedtuple
+
+import cachetools
+
+
+# ``urls`` are the external stylesheets that went into the ``html`` and
+# ``stylesheets`` is a digest of what they were.
+Result = namedtuple("Result", ["urls", "stylesheets", "html"])
+
+
+class ResultCache(object):
+    """Stores up to ``maxbytes`` (roughly) of results in memory, the least
+    recently used ones making way for new ones. Or in ``storage``, if given,
+    which is any mapping (like a ``cachetools`` cache or something that
+    stores them elsewhere) of the keys, which are strings, to ``Result``."""
+
+    def __init__(self, maxbytes=10 * 1024 * 1024, storage=None):
+        if storage is None:
+            storage = cachetools.LRUCache(
+                maxsize=maxbytes, getsizeof=lambda result: len(result.html)
+            )
+        self.maxbytes = maxbytes
+        self.storage = storage
+        self._lock = threading.RLock()
+
+    def get(self, key):
+        """Returns the ``Result`` stored by a key or ``None``."""
+        with self._lock:
+            return self.storage.get(key)
+
+    def set(self, key, result):
+        with self._lock:
+            try:
+                self.storage[key] = result
+            except ValueError:
+                pass  # too large
+
+    def clear(self):
+        with self._lock:
+            self.storage.clear()
@@ -0,0 +1,144 @@
+import asyncio
+import os
+import unittest
+
+import mock
+from requests.exceptions import HTTPError
+
+from premailer.aio import ExecutorClient, Response
+from premailer.http_cache import StylesheetCache
+from premailer.premailer import Premailer
+
+
+HTML = """<html>
+<head>
+<link rel="stylesheet" href="https://example.com/1.css">
+<link rel="stylesheet" href="https://example.com/2.css">
+<style>h1 { font-weight: bold }</style>
+</head>
+<body>
+<h1>Hello</h1>
+</body>
+</html>"""
+
+
+def run(coroutine):
+    # run() is only in Python 3.7 and later.
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class FakeClient(object):
+    """Answers with the stylesheets, once all ``concurrency`` requests have
+    been made."""
+
+    def __init__(self, stylesheets, concurrency=1):
+        self.stylesheets = stylesheets
+        self.concurrency = concurrency
+        self.requests = []
+        self.all_made = None
+
+    async def get(self, url, headers=None, verify=True, timeout=None):
+        if self.all_made is None:
+            # Made in the event loop, for the Pythons which bind it to one.
+            self.all_made = asyncio.Event()
+        self.requests.append((url, headers, verify, timeout))
+        if len(self.requests) >= self.concurrency:
+            self.all_made.set()
+        await asyncio.wait_for(self.all_made.wait(), 5)
+        if url not in self.stylesheets:
+            return Response(url, 404, "Not Found")
+        return Response(url, 200, self.stylesheets[url])
+
+
+class TestAtransform(unittest.TestCase):
+    def test_atransform(self):
+        stylesheets = {
+            "https://example.com/1.css": "h1 { color: red }",
+            "https://example.com/2.css": "h1 { color: blue }",
+            "https://example.com/3.css": "h1 { color: green }",
+        }
+
+        async def atransform():
+            client = FakeClient(stylesheets, concurrency=3)
+            p = Premailer(
+                HTML,
+                external_styles=["https://example.com/3.css"],
+                fetch_timeout=10,
+            )
+            result_html = await p.atransform(client=client)
+            return result_html, client.requests
+
+        result_html, requests = run(atransform())
+
+        with mock.patch.object(
+            Premailer, "_load_external_url", side_effect=stylesheets.get
+        ):
+            expect_html = Premailer(
+                HTML, external_styles=["https://example.com/3.css"]
+            ).transform()
+        self.assertEqual(result_html, expect_html)
+        self.assertIn('<h1 style="color:green; font-weight:bold">', result_html)
+        self.assertEqual(
+            sorted(requests),
+            [(url, None, True, 10) for url in sorted(stylesheets)],
+        )
+
+    def test_atransform_error(self):
+        client = FakeClient({"https://example.com/1.css": "h1 { color: red }"})
+        p = Premailer(HTML)
+        self.assertRaises(HTTPError, run, p.atransform(client=client))
+
+    def test_atransform_files_and_cache(self):
+        here = os.path.dirname(__file__)
+        client = FakeClient({"https://example.com/brand.css": "h1 { color: red }"})
+        cache = StylesheetCache()
+        stylesheet = Premailer(
+            css_text="p { color: blue }", stylesheet_cache=cache
+        ).compile()
+        html = """<html><head>
+        <link rel="stylesheet" href="https://example.com/brand.css">
+        <link rel="stylesheet" href="%s">
+        </head><body><h1>Hello</h1><p>World</p></body></html>""" % (
+            os.path.join(here, "test-external-styles.css")
+        )
+        stylesheet.premailer.allow_loading_external_files = True
+        for i in range(2):
+            result_html = run(stylesheet.aapply(html, client=client))
+            self.assertIn('<p style="color:blue">World</p>', result_html)
+            # The file comes after the url.
+            self.assertIn('<h1 style="color:brown">Hello</h1>', result_html)
+        # The response had no caching headers.
+        self.assertEqual(len(client.requests), 2)
+
+    def test_executor_client(self):
+        session = mock.MagicMock()
+        session.get.return_value = Response(
+            "https://example.com/1.css", 200, "h1 { color: red }"
+        )
+        client = ExecutorClient(session)
+        response = run(client.get("https://example.com/1.css", timeout=3))
+        self.assertEqual(response.text, "h1 { color: red }")
+        session.get.assert_called_once_with(
+            "https://example.com/1.css", verify=True, timeout=3
+        )
+
+        p = Premailer(
+            '<html><head><link rel="stylesheet" href="https://example.com/1.css">'
+            "</head><body><h1>Hi</h1></body></html>",
+            session=session,
+        )
+        self.assertIn('<h1 style="color:red">Hi</h1>', run(p.atransform()))
+
+    def test_atransform_bytes(self):
+        html = '<html><head><meta charset="iso-8859-1"></head><body><h1>Caf\xe9</h1>'
+        html = html.encode("iso-8859-1")
+        p = Premailer(css_text="h1 { color: red }")
+        expect_html = p.transform(html, output="bytes")
+        self.assertIn(b'<h1 style="color:red">Caf\xe9</h1>', expect_html)
+        self.assertEqual(run(p.atransform(html, output="bytes")), expect_html)
+        stylesheet = p.compile()
+        self.assertEqual(run(stylesheet.aapply(html, output="bytes")), expect_html)
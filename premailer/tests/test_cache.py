@@ -13,6 +13,9 @@ class TestFunctionCache(unittest.TestCase):
             "PREMAILER_CACHE",
             "PREMAILER_CACHE_MAXSIZE",
             "PREMAILER_CACHE_TTL",
+            "PREMAILER_CACHE_SELECTOR",
+            "PREMAILER_CACHE_SELECTOR_MAXSIZE",
+            "PREMAILER_CACHE_SELECTOR_MAXBYTES",
         ):
             try:
                 del os.environ[key]
@@ -40,10 +43,104 @@ class TestFunctionCache(unittest.TestCase):
             "cache.py", os.path.join("premailer", "cache.py")
         )
 
+        cache = cache_module.new_cache("selector")
+        self.assertEquals(type(cache), cachetools.TTLCache)
+        self.assertEquals(cache.maxsize, 50)
+        self.assertEquals(cache.ttl, 10)
+
+        # The deprecated shared cache is configured the same way.
         self.assertEquals(type(cache_module.cache), cachetools.TTLCache)
         self.assertEquals(cache_module.cache.maxsize, 50)
         self.assertEquals(cache_module.cache.ttl, 10)
 
+    def test_replacing_shared_cache(self):
+        cache_module = imp.load_source(
+            "cache.py", os.path.join("premailer", "cache.py")
+        )
+
+        @cache_module.function_cache("selector")
+        def selector(text):
+            return "selector " + text
+
+        @cache_module.function_cache("declarations")
+        def declarations(text):
+            return "declarations " + text
+
+        shared = cachetools.LRUCache(maxsize=10)
+        cache_module.cache = shared
+        self.assertEqual(selector("p"), "selector p")
+        self.assertEqual(declarations("p"), "declarations p")
+        self.assertEqual(len(shared), 2)
+        self.assertEqual(len(cache_module.caches["selector"]), 0)
+
+    def test_per_function_cache_settings(self):
+        os.environ["PREMAILER_CACHE_MAXSIZE"] = "50"
+        os.environ["PREMAILER_CACHE_SELECTOR"] = "LRU"
+        os.environ["PREMAILER_CACHE_SELECTOR_MAXSIZE"] = "500"
+
+        cache_module = imp.load_source(
+            "cache.py", os.path.join("premailer", "cache.py")
+        )
+
+        @cache_module.function_cache("selector")
+        def selector(text):
+            return "selector " + text
+
+        @cache_module.function_cache("declarations")
+        def declarations(text):
+            return "declarations " + text
+
+        selector_cache = cache_module.caches["selector"]
+        declarations_cache = cache_module.caches["declarations"]
+        self.assertEqual(type(selector_cache), cachetools.LRUCache)
+        self.assertEqual(selector_cache.maxsize, 500)
+        self.assertEqual(type(declarations_cache), cachetools.LFUCache)
+        self.assertEqual(declarations_cache.maxsize, 50)
+
+        # The same argument doesn't collide across functions.
+        self.assertEqual(selector("p"), "selector p")
+        self.assertEqual(declarations("p"), "declarations p")
+        self.assertEqual(selector("p"), "selector p")
+        self.assertEqual(len(selector_cache), 1)
+        self.assertEqual(len(declarations_cache), 1)
+
+        cache_module.clear("selector")
+        self.assertEqual(len(selector_cache), 0)
+        self.assertEqual(len(declarations_cache), 1)
+        cache_module.clear()
+        self.assertEqual(len(declarations_cache), 0)
+
+    def test_maxbytes(self):
+        os.environ["PREMAILER_CACHE_MAXSIZE"] = "50"
+        os.environ["PREMAILER_CACHE_SELECTOR_MAXBYTES"] = "1000"
+
+        cache_module = imp.load_source(
+            "cache.py", os.path.join("premailer", "cache.py")
+        )
+
+        # A configured maximum size wins over a default maximum of bytes.
+        self.assertEqual(cache_module.new_cache("text", maxbytes=2000).maxsize, 50)
+        del os.environ["PREMAILER_CACHE_MAXSIZE"]
+        self.assertEqual(cache_module.new_cache("text", maxbytes=2000).maxsize, 2000)
+        self.assertEqual(cache_module.new_cache("text").maxsize, 128)
+
+        @cache_module.function_cache("selector", key=len)
+        def selector(text):
+            return text * 2
+
+        cache = cache_module.caches["selector"]
+        self.assertEqual(cache.maxsize, 1000)
+        selector("a" * 200)
+        self.assertEqual(len(cache), 1)
+        self.assertTrue(cache.currsize > 400)
+        # Same key
+        self.assertEqual(selector("b" * 200), "a" * 400)
+        # Too large for the cache
+        selector("c" * 600)
+        selector("d" * 300)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(list(cache), [("selector", 300)])
+
     def test_cache_multithread_synchronization(self):
         """
         Tests thread safety of internal cache access.
@@ -87,13 +184,13 @@ class TestFunctionCache(unittest.TestCase):
             "cache.py", os.path.join("premailer", "cache.py")
         )
 
-        # Set module cache to point to overridden implementation.
-        cache_module.cache = DelayedDeletionLRUCache(maxsize=1)
-
         @cache_module.function_cache()
         def get_styles(rule):
             return RULES_MAP[rule]
 
+        # Set the function's cache to the overridden implementation.
+        cache_module.set_cache("get_styles", DelayedDeletionLRUCache(maxsize=1))
+
         threads = [RuleMapper() for _ in range(2)]
         for thread in threads:
             thread.start()
@@ -105,3 +202,29 @@ class TestFunctionCache(unittest.TestCase):
         self.assertTrue(
             not exceptions, "Unexpected exception when accessing Premailer cache."
         )
+
+    def test_stats(self):
+        cache_module = imp.load_source(
+            "cache.py", os.path.join("premailer", "cache.py")
+        )
+
+        @cache_module.function_cache()
+        def double(text):
+            return text * 2
+
+        cache_module.set_cache("double", cachetools.LRUCache(maxsize=2))
+        for text in ("a", "b", "a", "c", "d", "d"):
+            double(text)
+
+        stats = cache_module.stats()["double"]
+        self.assertEqual(stats["hits"], 2)
+        self.assertEqual(stats["misses"], 4)
+        self.assertEqual(stats["evictions"], 2)
+        self.assertEqual(stats["size"], 2)
+        self.assertEqual(stats["maxsize"], 2)
+        self.assertTrue(stats["memory"] > 0)
+
+        cache_module.reset_stats("double")
+        stats = cache_module.stats()["double"]
+        self.assertEqual(stats["hits"] + stats["misses"] + stats["evictions"], 0)
+        self.assertEqual(stats["size"], 2)
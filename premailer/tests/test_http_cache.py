@@ -0,0 +1,150 @@
+import shutil
+import tempfile
+import unittest
+
+import mock
+from requests.exceptions import HTTPError
+
+from premailer.http_cache import StylesheetCache
+from premailer.premailer import Premailer
+
+
+class Response(object):
+    def __init__(self, text="", status_code=200, headers=None):
+        self.text = text
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise HTTPError("Error: %s" % self.status_code, response=self)
+
+
+class Server(object):
+    """Answers the requests with the responses, in turn."""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def get(self, url, headers):
+        self.requests.append((url, headers))
+        return self.responses.pop(0)
+
+
+URL = "https://example.com/brand.css"
+
+
+class TestStylesheetCache(unittest.TestCase):
+    @mock.patch("premailer.http_cache.time")
+    def test_max_age(self, mocked_time):
+        mocked_time.time.return_value = 1000.0
+        cache = StylesheetCache()
+        server = Server(
+            Response("h1 { color: red }", headers={"Cache-Control": "max-age=60"}),
+            Response("h1 { color: blue }", headers={"Cache-Control": "max-age=60"}),
+        )
+        self.assertEqual(cache.load(URL, server.get), "h1 { color: red }")
+        mocked_time.time.return_value = 1059.0
+        self.assertEqual(cache.load(URL, server.get), "h1 { color: red }")
+        self.assertEqual(len(server.requests), 1)
+        mocked_time.time.return_value = 1061.0
+        self.assertEqual(cache.load(URL, server.get), "h1 { color: blue }")
+        self.assertEqual(server.requests[1], (URL, {}))
+
+    @mock.patch("premailer.http_cache.time")
+    def test_expires(self, mocked_time):
+        mocked_time.time.return_value = 1000.0
+        cache = StylesheetCache()
+        headers = {
+            "Date": "Wed, 21 Oct 2015 07:28:00 GMT",
+            "Expires": "Wed, 21 Oct 2015 07:29:00 GMT",
+        }
+        server = Server(Response("h1 { color: red }", headers=headers))
+        cache.load(URL, server.get)
+        self.assertEqual(cache.get(URL).expires, 1060.0)
+
+    def test_revalidate(self):
+        cache = StylesheetCache()
+        server = Server(
+            Response(
+                "h1 { color: red }",
+                headers={
+                    "cache-control": "no-cache",
+                    "etag": '"abc"',
+                    "last-modified": "Wed, 21 Oct 2015 07:28:00 GMT",
+                },
+            ),
+            Response(status_code=304),
+            Response("h1 { color: blue }", headers={"ETag": '"def"'}),
+            Response("h1 { color: green }"),
+        )
+        self.assertEqual(cache.load(URL, server.get), "h1 { color: red }")
+        self.assertEqual(cache.load(URL, server.get), "h1 { color: red }")
+        self.assertEqual(
+            server.requests[1][1],
+            {
+                "If-None-Match": '"abc"',
+                "If-Modified-Since": "Wed, 21 Oct 2015 07:28:00 GMT",
+            },
+        )
+        self.assertEqual(cache.load(URL, server.get), "h1 { color: blue }")
+        self.assertEqual(server.requests[2][1], server.requests[1][1])
+        self.assertEqual(cache.load(URL, server.get), "h1 { color: green }")
+        self.assertEqual(server.requests[3][1], {"If-None-Match": '"def"'})
+
+    def test_not_stored(self):
+        cache = StylesheetCache()
+        server = Server(
+            Response("a", headers={"Cache-Control": "no-store, max-age=60"}),
+            Response("b"),
+            Response("c", status_code=500),
+        )
+        self.assertEqual(cache.load(URL, server.get), "a")
+        self.assertEqual(cache.get(URL), None)
+        self.assertEqual(cache.load(URL, server.get), "b")
+        self.assertEqual(cache.get(URL), None)
+        self.assertRaises(HTTPError, cache.load, URL, server.get)
+        self.assertEqual(cache.get(URL), None)
+
+    def test_maxbytes(self):
+        cache = StylesheetCache(maxbytes=10)
+        headers = {"Cache-Control": "max-age=60"}
+        server = Server(
+            Response("a" * 6, headers=headers),
+            Response("b" * 6, headers=headers),
+            Response("c" * 11, headers=headers),
+        )
+        cache.load(URL + "?a", server.get)
+        cache.load(URL + "?b", server.get)
+        cache.load(URL + "?c", server.get)
+        self.assertEqual(cache.get(URL + "?a"), None)
+        self.assertEqual(cache.get(URL + "?b").text, "b" * 6)
+        self.assertEqual(cache.get(URL + "?c"), None)
+
+    def test_directory(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        server = Server(Response("a", headers={"Cache-Control": "max-age=60"}))
+        StylesheetCache(directory=directory).load(URL, server.get)
+        # Another process
+        self.assertEqual(StylesheetCache(directory=directory).load(URL, None), "a")
+
+        cache = StylesheetCache(directory=directory)
+        cache.clear()
+        self.assertEqual(cache.get(URL), None)
+
+    def test_premailer(self):
+        session = mock.MagicMock()
+        session.get.return_value = Response(
+            "h1 { color: red }", headers={"Cache-Control": "max-age=60"}
+        )
+        cache = StylesheetCache()
+        html = '<html><head><link rel="stylesheet" href="%s"></head>' % URL
+        html += "<body><h1>Hi</h1></body></html>"
+        for i in range(3):
+            result_html = Premailer(
+                html, session=session, stylesheet_cache=cache
+            ).transform()
+            self.assertIn('<h1 style="color:red">Hi</h1>', result_html)
+        session.get.assert_called_once_with(URL, verify=True)
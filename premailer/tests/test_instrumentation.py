@@ -0,0 +1,109 @@
+import unittest
+from io import BytesIO
+
+from premailer.instrumentation import Timings
+from premailer.premailer import Premailer
+
+
+HTML = """<html>
+<head>
+<style type="text/css">
+h1 { color: red }
+p, .lead { font-size: 12px; background-color: #eee }
+a:hover { color: blue }
+</style>
+</head>
+<body>
+<h1>Title</h1>
+<p class="lead">One <a href="/one">link</a></p>
+<p>Two <img src="/two.png" style="float: left"></p>
+</body>
+</html>"""
+
+
+class TestInstrumentation(unittest.TestCase):
+    def test_timings(self):
+        timings = Timings()
+        p = Premailer(
+            HTML,
+            base_url="http://example.com",
+            css_text="img { border: 0 }",
+            remove_classes=True,
+            instrumentation=timings,
+        )
+        result_html = p.transform()
+
+        totals = timings.totals
+        self.assertEqual(
+            set(totals),
+            {
+                "parse_html",
+                "stylesheet",
+                "parse_css",
+                "match",
+                "select",
+                "merge",
+                "basic_attributes",
+                "post_process",
+                "serialize",
+            },
+        )
+        for name, total in totals.items():
+            self.assertTrue(total["seconds"] >= 0, name)
+        self.assertEqual(totals["parse_css"]["calls"], 2)
+        # h1, p, .lead and img
+        self.assertEqual(totals["parse_css"]["rules"], 4)
+        self.assertEqual(totals["parse_css"]["leftover"], 1)
+        self.assertEqual(totals["select"]["calls"], 4)
+        self.assertEqual(totals["match"]["elements"], 4)
+        self.assertEqual(totals["merge"]["elements"], 4)
+        self.assertEqual(totals["post_process"]["elements"], 9)
+        self.assertEqual(totals["serialize"]["bytes"], len(result_html.encode("utf-8")))
+
+    def test_callback(self):
+        events = []
+
+        def callback(event, name, data):
+            events.append((event, name, dict(data)))
+
+        Premailer(
+            HTML, instrumentation=callback, matching_engine="single-pass"
+        ).transform()
+
+        names = [name for event, name, data in events if event == "start"]
+        self.assertEqual(
+            names,
+            [
+                "parse_html",
+                "stylesheet",
+                "parse_css",
+                "match",
+                "merge",
+                "basic_attributes",
+                "post_process",
+                "serialize",
+            ],
+        )
+        # Spans are nested and stop in the opposite order of starting.
+        stack = []
+        for event, name, data in events:
+            if event == "start":
+                stack.append(name)
+            else:
+                self.assertEqual(stack.pop(), name)
+        self.assertEqual(stack, [])
+        self.assertIn(("stop", "stylesheet", {"tag": "style", "href": None}), events)
+        self.assertIn(
+            (
+                "stop",
+                "match",
+                {"engine": "single-pass", "rules": 3, "elements": 3, "skipped": 0},
+            ),
+            events,
+        )
+
+    def test_transform_to_bytes(self):
+        timings = Timings()
+        f = BytesIO()
+        Premailer(HTML, instrumentation=timings).transform_to(f)
+        self.assertEqual(timings.totals["serialize"]["bytes"], len(f.getvalue()))
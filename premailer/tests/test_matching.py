@@ -0,0 +1,186 @@
+import unittest
+
+import mock
+from lxml import etree
+from lxml.cssselect import CSSSelector
+
+from premailer.matching import (
+    compile_selector,
+    match_single_pass,
+    match_xpath,
+    possible_rules,
+    selector_requirements,
+    selectors_in_use,
+)
+from premailer.premailer import Premailer
+
+
+HTML = """<html>
+<head><title>Matching</title></head>
+<body id="body">
+<!-- a comment -->
+<div id="main" class="wrapper  content">
+  <h1 class="title">Title</h1>
+  <p class="lead first">
+    One <a href="http://example.com" rel="nofollow external">a</a>
+  </p>
+  <p lang="en-US">Two</p>
+  <p></p>
+  <ul>
+    <li>1</li><li class="odd">2</li><li>3</li><!-- x --><li>4</li><li>5</li>
+  </ul>
+  <span>x</span><em>y</em><span>z</span>
+</div>
+<table><tr><td align="center">cell</td></tr></table>
+</body>
+</html>"""
+
+SELECTORS = [
+    "*",
+    "p",
+    "#main",
+    ".title",
+    "div.wrapper.content",
+    "div#main > h1",
+    "body p",
+    "div p a",
+    "ul > li",
+    "h1 + p",
+    "h1 ~ p",
+    "span + em",
+    "em ~ span",
+    "a[href]",
+    "a[href^=http]",
+    "a[href$='.com']",
+    "a[href*=example]",
+    "a[rel~=external]",
+    "p[lang|=en]",
+    "td[align=center]",
+    "li:first-child",
+    "li:last-child",
+    "li:nth-child(2n+1)",
+    "li:nth-child(odd)",
+    "li:nth-child(-n+2)",
+    "li:nth-last-child(2)",
+    "span:first-of-type",
+    "span:last-of-type",
+    "em:only-of-type",
+    "p:empty",
+    "p:not(.lead)",
+    ":root",
+    "html",
+    "p:lang(en)",
+    "h2",
+    ".nothing p",
+]
+
+
+class Rule(object):
+    def __init__(self, selector):
+        self.selector = selector
+        self.cssselector = CSSSelector(selector)
+
+
+class TestMatching(unittest.TestCase):
+    def test_engines_agree(self):
+        page = etree.fromstring(HTML, etree.HTMLParser())
+        rules = [Rule(selector) for selector in SELECTORS]
+
+        def normalize(matches):
+            return {
+                page.getroottree().getpath(element): [r.selector for r in matched]
+                for element, matched in matches
+            }
+
+        self.assertEqual(
+            normalize(match_xpath(page, rules)),
+            normalize(match_single_pass(page, rules)),
+        )
+
+    def test_compile_selector_buckets(self):
+        self.assertEqual(compile_selector("div p#x.y")[0], ("id", "x"))
+        self.assertEqual(compile_selector("div p.y")[0], ("class", "y"))
+        self.assertEqual(compile_selector("div > p")[0], ("tag", "p"))
+        self.assertEqual(compile_selector("div *")[0], ("*", None))
+        # Not something the single-pass engine can do by itself
+        self.assertEqual(compile_selector("p:lang(en)"), None)
+        self.assertEqual(compile_selector("p::first-line"), None)
+
+    def test_possible_rules(self):
+        page = etree.fromstring(HTML, etree.HTMLParser())
+        rules = [Rule(selector) for selector in SELECTORS + ["p#main", "b a"]]
+        possible = possible_rules(page, rules)
+        self.assertEqual(
+            [rule.selector for rule in rules if rule not in possible],
+            ["h2", ".nothing p", "b a"],
+        )
+        # None that are left out match anything.
+        for rule in rules:
+            if rule not in possible:
+                self.assertEqual(rule.cssselector(page), [])
+
+        self.assertEqual(
+            selector_requirements("div#x.y > p:not(.z) *"),
+            {("tag", "div"), ("id", "x"), ("class", "y"), ("tag", "p")},
+        )
+        self.assertEqual(selector_requirements("[class~=x]"), frozenset())
+        self.assertEqual(selector_requirements("p:::"), frozenset())
+
+    def test_selectors_in_use(self):
+        page = etree.fromstring(HTML, etree.HTMLParser())
+        selectors = SELECTORS + ["p#main", "b a", "p >"]
+        for engine in ("xpath", "single-pass"):
+            self.assertEqual(
+                selectors_in_use(page, selectors, engine),
+                {x for x in SELECTORS if CSSSelector(x)(page)} | {"p >"},
+            )
+
+    def test_selectors_in_use_builds_only_needed_selectors(self):
+        page = etree.fromstring(HTML, etree.HTMLParser())
+        selectors = ["p", "#nothing", ".missing a", "p:contains(Two)", "p >"]
+        # Not those the document doesn't have the id or class of, nor, for
+        # the single-pass engine, those it can match by itself.
+        built = {
+            "xpath": ["p", "p:contains(Two)", "p >"],
+            "single-pass": ["p:contains(Two)", "p >"],
+        }
+        for engine in ("xpath", "single-pass"):
+            with mock.patch(
+                "premailer.matching._create_cssselector", side_effect=CSSSelector
+            ) as create:
+                self.assertEqual(
+                    selectors_in_use(page, selectors, engine),
+                    {"p", "p:contains(Two)", "p >"},
+                )
+            self.assertEqual(
+                sorted(args[0] for args, kwargs in create.call_args_list),
+                sorted(built[engine]),
+            )
+
+    def test_single_pass_transform(self):
+        html = """<html>
+        <head>
+        <style>
+        p { color: red; font-size: 12px }
+        .lead { color: blue }
+        div > p:first-child { font-weight: bold }
+        #main p.lead { font-size: 14px }
+        td { background-color: #eee }
+        </style>
+        </head>
+        <body>
+        <div id="main">
+        <p class="lead">One</p>
+        <p>Two</p>
+        </div>
+        <table><tr><td>Three</td></tr></table>
+        </body>
+        </html>"""
+        self.assertEqual(
+            Premailer(html, matching_engine="single-pass").transform(),
+            Premailer(html).transform(),
+        )
+
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            Premailer(matching_engine="UNKNOWN")
@@ -1,5 +1,14 @@
 import unittest
-from premailer.merge_style import csstext_to_pairs, merge_styles
+
+import cssutils
+
+from premailer.merge_style import (
+    StyleAccumulator,
+    _parse_declarations,
+    csstext_to_pairs,
+    format_value,
+    merge_styles,
+)
 
 
 class TestMergeStyle(unittest.TestCase):
@@ -15,3 +24,80 @@ class TestMergeStyle(unittest.TestCase):
         # Invalid syntax does not raise
         inline = "{color:pink} :hover{color:purple} :active{color:red}"
         merge_styles(inline, [], [])
+
+    def test_parse_declarations_like_cssutils(self):
+        for csstext in (
+            "color:red",
+            "COLOR: Red;font-size:12PX",
+            "margin: 0px 0 0.5em -1em",
+            "color:#FFFFFF; background-color:#aabbcc; border-color:#AbC",
+            "font-family: 'Helvetica Neue',Arial , sans-serif",
+            "background:url( 'a b.png' ) no-repeat;background-image:url(a.png)",
+            'background:url("data:image/png;base64,iVBORw0KGg")',
+            "font:12px / 1.5 Arial",
+            "color:red ! IMPORTANT;/* a comment */padding:0",
+            "content:'a\"b';;",
+            "padding:0PT 0% 0Em",
+        ):
+            expected = [
+                (prop.name.strip(), format_value(prop))
+                for prop in cssutils.parseStyle(csstext, validate=False)
+            ]
+            self.assertEqual(_parse_declarations(csstext), expected, csstext)
+        # Zeros whose unit cssutils keeps, which it's left to do.
+        for csstext in ("transition:opacity 0s ease", "rotate:0deg", "height:0vh"):
+            expected = [
+                (prop.name.strip(), format_value(prop))
+                for prop in cssutils.parseStyle(csstext, validate=False)
+            ]
+            self.assertEqual(csstext_to_pairs(csstext, validate=False), expected)
+
+    def test_parse_declarations_gives_up(self):
+        for csstext in (
+            "width:calc(100% - 10px)",
+            "color:rgb(1,2,3)",
+            "color:red/* a comment */",
+            "color:red;color:blue",
+            "content:'\\201C'",
+            "color:#1234",
+            "margin:0.50em",
+            "width:1e3px",
+            "color:",
+            "transition:opacity 0s ease",
+            "rotate:0deg",
+            "height:0vh",
+            "width:0rem",
+        ):
+            self.assertEqual(_parse_declarations(csstext), None, csstext)
+
+    def test_csstext_to_pairs_without_validation_skips_cssutils(self):
+        class Lock(object):
+            def __enter__(self):
+                raise AssertionError("cssutils should not be used")
+
+        lock = csstext_to_pairs._lock
+        csstext_to_pairs._lock = Lock()
+        try:
+            self.assertEqual(
+                csstext_to_pairs("font-size:3px;color:#ffffff", validate=False),
+                [("font-size", "3px"), ("color", "#fff")],
+            )
+        finally:
+            csstext_to_pairs._lock = lock
+
+    def test_style_accumulator(self):
+        styles = StyleAccumulator()
+        styles.add((("color", "red"), ("margin", "0")))
+        styles.add((("color", "blue"),), ":hover")
+        styles.add((("margin", "1px"), ("padding", "unset")))
+        styles.add((("text-decoration", "none"),), ":hover")
+        self.assertEqual(
+            styles.to_string("padding:2px", remove_unset_properties=True),
+            "{color:red; margin:1px; padding:2px} "
+            ":hover{color:blue; text-decoration:none}",
+        )
+
+        styles = StyleAccumulator()
+        styles.add((("color", "unset"),), ":hover")
+        styles.add((("color", "red"),))
+        self.assertEqual(styles.to_string(remove_unset_properties=True), "color:red")
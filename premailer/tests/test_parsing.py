@@ -0,0 +1,107 @@
+import unittest
+
+from premailer.parsing import (
+    Declaration,
+    MediaRule,
+    OtherRule,
+    StyleRule,
+    parse_cssutils,
+    parse_fast,
+    to_string,
+)
+from premailer.premailer import Premailer
+
+
+CSS = """
+@charset "utf-8";
+/* a comment */
+h1, h2 { color:red; }
+ul  li{list-style: 2px;}
+a>b , C  D{color:#FFFFFF;margin:0px;color:red}
+p { x:y !important; x: z; font-family: 'Helvetica Neue', Arial }
+div { background: url(data:image/png;base64,iVBORw0KGg) no-repeat }
+p.fade { transition: opacity 0s ease; animation-delay: 0ms; margin: 0PX }
+li:nth-child(2n+1) + li ~ i[title="a b"] { COLOR : Red ! important }
+@font-face { font-family: x; src: url(x.woff) }
+@media screen and (max-width:600px) {
+    /* in media */
+    table[class="container"] { width: 100% !important; }
+}
+a:hover { text-decoration: underline }
+"""
+
+
+class TestParsing(unittest.TestCase):
+    def test_parsers_agree(self):
+        self.assertEqual(parse_fast(CSS), parse_cssutils(CSS, validate=False))
+
+    def test_parse_fast(self):
+        rules = parse_fast(CSS)
+        self.assertEqual(
+            rules[3],
+            StyleRule(
+                "p",
+                (
+                    Declaration("x", "y", "important"),
+                    Declaration("font-family", '"Helvetica Neue", Arial', ""),
+                ),
+            ),
+        )
+        self.assertEqual(
+            rules[-2],
+            MediaRule(
+                "screen and (max-width: 600px)",
+                (
+                    OtherRule("/* in media */"),
+                    StyleRule(
+                        'table[class="container"]',
+                        (Declaration("width", "100%", "important"),),
+                    ),
+                ),
+            ),
+        )
+
+    def test_parse_fast_invalid_css(self):
+        self.assertEqual(
+            parse_fast("p { color red; font-size: 12px } } ; div { color: blue"),
+            (
+                StyleRule("p", (Declaration("font-size", "12px", ""),)),
+                StyleRule("div", (Declaration("color", "blue", ""),)),
+            ),
+        )
+
+    def test_to_string(self):
+        rule = parse_fast("@media print { /* c */ p { color: red } div {} }")[0]
+        self.assertEqual(
+            to_string(rule, important=True),
+            "@media print {\n"
+            "    /* c */\n"
+            "    p {\n"
+            "        color: red !important\n"
+            "        }\n"
+            "    }",
+        )
+        self.assertEqual(to_string(rule), to_string(parse_cssutils(to_string(rule))[0]))
+
+    def test_fast_transform(self):
+        html = """<html>
+        <head>
+        <style>%s</style>
+        </head>
+        <body>
+        <h1>Title</h1>
+        <ul><li>One</li><li>Two</li></ul>
+        <p>Hi <a href="#">there</a></p>
+        <table class="container"><tr><td>Cell</td></tr></table>
+        </body>
+        </html>""" % (
+            CSS,
+        )
+        self.assertEqual(
+            Premailer(html, css_parser="fast").transform(),
+            Premailer(html, disable_validation=True).transform(),
+        )
+
+    def test_unknown_parser(self):
+        with self.assertRaises(ValueError):
+            Premailer(css_parser="UNKNOWN")
@@ -1,25 +1,32 @@
 import logging
 import re
+import pickle
 import sys
 import os
 import unittest
 from contextlib import contextmanager
-from io import StringIO
+from io import BytesIO, StringIO, TextIOWrapper
 import tempfile
+import threading
 
 from lxml.etree import XMLSyntaxError, fromstring
 from requests.exceptions import HTTPError
 import mock
+import premailer.cache
+import premailer.parsing
 import premailer.premailer  # lint:ok
 from nose.tools import assert_raises, eq_, ok_
 from premailer.__main__ import main
 from premailer.premailer import (
+    CompiledStylesheet,
     ExternalNotFoundError,
     ExternalFileLoadingError,
     Premailer,
+    _SubstitutingWriter,
     csstext_to_pairs,
     merge_styles,
     transform,
+    transform_many,
 )
 
 
@@ -561,6 +568,40 @@ class Tests(unittest.TestCase):
         k, v = leftover[0]
         eq_((k, v), ("a:hover", "text-decoration:underline"), (k, v))
 
+    def test_exact_specificity(self):
+        html = """<html>
+        <head>
+        <style type="text/css">
+        a[href] { color: red }
+        p:first-child { font-weight: bold }
+        a { color: blue }
+        p { font-weight: normal }
+        </style>
+        </head>
+        <body>
+        <p><a href="/">Link</a></p>
+        </body>
+        </html>"""
+
+        expect_html = """<html>
+        <head>
+        </head>
+        <body>
+        <p style="font-weight:bold"><a href="/" style="color:red">Link</a></p>
+        </body>
+        </html>"""
+
+        p = Premailer(html)
+        result_html = p.transform()
+
+        compare_html(expect_html, result_html)
+
+        specificity = premailer.premailer._specificity
+        eq_(specificity("span:not(.plain)"), (0, 1, 1))
+        eq_(specificity("#main > ul li[lang|=en]"), (1, 1, 2))
+        # Counted crudely if cssselect can't parse it
+        eq_(specificity("a:::hover"), (0, 0, 1))
+
     def test_precedence_comparison(self):
         p = Premailer("html")  # won't need the html
         rules, leftover = p._parse_style_rules(
@@ -1738,6 +1779,26 @@ ground:red}/*]]>*/</style>
 
         compare_html(expect_html, result_html)
 
+    def test_command_line_binary_stdio(self):
+        html = (
+            '<html><head><meta charset="windows-1252"></head>'
+            "<style>p { color:red; }</style><p>\u20ac</p></html>"
+        )
+        expect_html = """<html><head><meta charset="windows-1252"></head>
+        <body><p style="color:red">\u20ac</p></body></html>"""
+
+        old_stdin, old_stdout = sys.stdin, sys.stdout
+        sys.stdin = TextIOWrapper(BytesIO(html.encode("windows-1252")))
+        sys.stdout = TextIOWrapper(BytesIO())
+        try:
+            main([])
+            result_html = sys.stdout.buffer.getvalue()
+        finally:
+            sys.stdin, sys.stdout = old_stdin, old_stdout
+
+        # In the encoding of the input.
+        compare_html(expect_html, result_html.decode("windows-1252"))
+
     def test_command_line_fileinput_from_argument(self):
         with captured_output() as (out, err):
             main(
@@ -2303,6 +2364,58 @@ ent:"" !important;display:block !important}
 
         compare_html(expect_html, result_html)
 
+    def test_prune_unused_css(self):
+        html = """<html>
+        <head>
+        <style>
+        a:hover { color: red }
+        .missing:hover { color: blue }
+        @media (max-width: 600px) {
+            h1, .nope { font-size: 12px }
+            .nope { color: green }
+        }
+        </style>
+        <style>
+        .missing::before { content: "x" }
+        @media print { .nope { display: none } }
+        </style>
+        </head>
+        <body>
+        <h1>Hi</h1>
+        <a href="#">link</a>
+        </body>
+        </html>"""
+
+        expect_html = """<html>
+        <head>
+        <style>a:hover {color:red}
+        @media (max-width: 600px) {
+            h1 {
+                font-size: 12px
+                }
+            }</style>
+        <style type="text/css">h1:hover {color:teal !important}</style>
+        </head>
+        <body>
+        <h1>Hi</h1>
+        <a href="#">link</a>
+        </body>
+        </html>"""
+
+        css_text = "p:hover { color: pink } h1:hover { color: teal }"
+        for engine in ("xpath", "single-pass"):
+            options = dict(
+                css_text=css_text, matching_engine=engine, prune_unused_css=True
+            )
+            compare_html(expect_html, Premailer(html, **options).transform())
+            compare_html(expect_html, Premailer(**options).compile().apply(html))
+
+        # Nothing is pruned from the style tags that are kept.
+        result_html = Premailer(
+            html, keep_style_tags=True, prune_unused_css=True
+        ).transform()
+        ok_(".missing::before" in result_html)
+
     @staticmethod
     def mocked_urlopen(url):
         'The standard "response" from the "server".'
@@ -2897,6 +3010,45 @@ sheet" type="text/css">
         result_html = p.transform()
         compare_html(expect_html, result_html)
 
+    def test_post_process(self):
+        """All the passes after inlining, done in the same walk."""
+        html = """<html>
+        <head>
+        <style>
+        .floatright { float: right; margin: 0 }
+        </style>
+        </head>
+        <body>
+        <p class="intro"><a href="/a" class="link">a</a>
+           <a href="#top">top</a>
+           <img src="/r.png" class="floatright">
+           <img src="cid:logo" style="FLOAT: left !important">
+        </body>
+        </html>"""
+
+        expect_html = """<html>
+<head>
+</head>
+<body>
+<p><a href="http://example.com/a">a</a>
+   <a href="#top">top</a>
+   <img src="http://example.com/r.png" style="Float:right; Margin:0" align="right">
+   <img src="cid:logo" style="Float: left !important" align="left">
+</p>
+</body>
+</html>"""
+
+        p = Premailer(
+            html,
+            base_url="http://example.com",
+            remove_classes=True,
+            capitalize_float_margin=True,
+            preserve_internal_links=True,
+            preserve_inline_attachments=True,
+        )
+        result_html = p.transform()
+        compare_html(expect_html, result_html)
+
     def test_remove_unset_properties(self):
         html = """<html>
         <head>
@@ -3081,6 +3233,26 @@ sheet" type="text/css">
         result_neglected_html = p.transform()
         compare_html(expected_neglected_html, result_neglected_html)
 
+    def test_preserve_handlebar_syntax_placeholders(self):
+        html = (
+            '<p><a href="{{url}}" title="{{ t | default: "<&>" }}">\u20ac</a>'
+            '<img src="logo.png" alt="{{alt}}"></p>'
+        )
+        expect_html = (
+            "<html><head></head><body>"
+            '<p><a href="{{url}}" title="{{ t | default: "<&>" }}">\u20ac</a>'
+            '<img src="http://example.com/logo.png" alt="{{alt}}">'
+            "</p></body></html>"
+        )
+        p = Premailer(preserve_handlebar_syntax=True, base_url="http://example.com")
+        eq_(p.transform(html, pretty_print=False), expect_html)
+        eq_(
+            p.transform(html.encode("utf-8"), pretty_print=False, output="bytes"),
+            expect_html.encode("utf-8"),
+        )
+        # Not where they're in text.
+        ok_("<p>{{url}}</p>" in p.transform("<p>{{url}}</p>"))
+
     def test_allow_loading_external_files(self):
         """Demonstrate the risks of allow_loading_external_files"""
         external_content = "foo { bar:buz }"
@@ -3109,3 +3281,333 @@ sheet" type="text/css">
             p = Premailer(html, allow_loading_external_files=True, keep_style_tags=True)
             out = p.transform()
             assert external_content in out
+
+    def test_external_files_cached(self):
+        """Files are read and parsed once until they change"""
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            tmp_file = os.path.join(tmpdirname, "external.css")
+            with open(tmp_file, "w") as f:
+                f.write("h1 { color: red } h6 { margin: 1px }")
+            html = """<html>
+            <head><link rel="stylesheet" href="external.css"></head>
+            <body><h1>Hello</h1></body>
+            </html>"""
+            p = Premailer(
+                html, base_path=tmpdirname, allow_loading_external_files=True
+            )
+            with mock.patch(
+                "premailer.premailer.CSS_PARSERS",
+                {"cssutils": mock.Mock(wraps=premailer.parsing.parse_cssutils)},
+            ) as parsers:
+                for i in range(3):
+                    ok_('<h1 style="color:red">' in p.transform())
+                eq_(parsers["cssutils"].call_count, 1)
+
+                with open(tmp_file, "w") as f:
+                    f.write("h1 { color: green } h6 { margin: 1px }")
+                ok_('<h1 style="color:green">' in p.transform())
+                eq_(parsers["cssutils"].call_count, 2)
+
+    def test_parsed_stylesheets_cached_by_digest(self):
+        css_text = "h1 { color: red }" + " p { margin: 0 }" * 100
+        Premailer(css_text=css_text).transform("<h1>Hi</h1>")
+        cache = premailer.cache.caches["stylesheet"]
+        ok_(cache.maxsize > 1000000)
+        for key in cache:
+            ok_(css_text not in key[1], key)
+
+    def test_styles_cached(self):
+        css_text = """
+        h1 { color: red }
+        a:hover { color: blue !important }
+        @media (max-width: 600px) { h1 { color: green } }
+        """
+        p = Premailer(css_text=css_text)
+        styles = p._parse_styles(css_text)
+        ok_(Premailer(css_text=css_text)._parse_styles(css_text) is styles)
+        ok_(Premailer(strip_important=False)._parse_styles(css_text) is not styles)
+        eq_(
+            styles.leftover_text,
+            "a:hover {color:blue !important}\n"
+            "@media (max-width: 600px) {\n"
+            "    h1 {\n"
+            "        color: green !important\n"
+            "        }\n"
+            "    }",
+        )
+        for i in range(2):
+            result_html = p.transform("<h1>Hi</h1>")
+            ok_("color: green !important\n" in result_html)
+        ok_(p._parse_styles(css_text) is styles)
+
+    def test_compiled_stylesheet(self):
+        """A compiled stylesheet can be applied to many documents and
+        behaves like transform()"""
+        css_text = """
+        h1 { color: red; }
+        .brand { color: purple; }
+        a:hover { color: pink; }
+        """
+        p = Premailer(css_text=css_text)
+        stylesheet = p.compile()
+        ok_(isinstance(stylesheet, CompiledStylesheet))
+
+        for name in ("Peter", "Paul"):
+            html = """<html>
+            <head>
+            <style>p { color: blue; } h1 { color: green; }</style>
+            </head>
+            <body>
+            <h1 class="brand">Hi %s</h1>
+            <p>Yes</p>
+            </body>
+            </html>""" % (
+                name,
+            )
+            result_html = stylesheet.apply(html)
+            eq_(result_html, p.transform(html))
+            ok_(
+                '<h1 class="brand" style="color:purple">Hi %s</h1>' % name
+                in result_html
+            )
+            ok_('<p style="color:blue">Yes</p>' in result_html)
+            ok_("a:hover {color:pink !important}" in result_html)
+
+    @mock.patch.object(Premailer, "_load_external_url")
+    def test_compiled_stylesheet_loads_external_styles_once(self, mocked_pleu):
+        mocked_pleu.return_value = "h1 { color: brown }"
+        p = Premailer(external_styles="https://example.com/brand.css")
+        stylesheet = p.compile()
+        for i in range(3):
+            result_html = stylesheet.apply("<h1>Hello</h1>")
+            ok_('<h1 style="color:brown">Hello</h1>' in result_html)
+        eq_(mocked_pleu.call_count, 1)
+
+    @mock.patch.object(Premailer, "_load_external_url")
+    def test_concurrent_fetches(self, mocked_pleu):
+        html = """<html>
+        <head>
+        <link href="https://example.com/1.css" rel="stylesheet">
+        <link href="https://example.com/2.css" rel="stylesheet">
+        </head>
+        <body>
+        <h1>Hello</h1>
+        </body>
+        </html>"""
+        # Only passes if all three are being loaded at the same time.
+        barrier = threading.Barrier(3, timeout=5)
+
+        def load(url):
+            barrier.wait()
+            return "h1 { color: %s }" % url.split("/")[-1][:-4]
+
+        mocked_pleu.side_effect = load
+        p = Premailer(
+            html,
+            external_styles="https://example.com/3.css",
+            max_concurrent_fetches=4,
+        )
+        result_html = p.transform()
+        # Applied in order, whichever is loaded first.
+        ok_('<h1 style="color:3">Hello</h1>' in result_html)
+        eq_(mocked_pleu.call_count, 3)
+
+        barrier.reset()
+        mocked_pleu.side_effect = HTTPError("Error: 404")
+        assert_raises(HTTPError, p.transform)
+
+    def test_fetch_timeout(self):
+        mocked_session = mock.MagicMock()
+        mocked_session.get.return_value = MockResponse("h1 { color: red }")
+        p = Premailer(
+            external_styles="https://example.com/site.css",
+            session=mocked_session,
+            fetch_timeout=2.5,
+        )
+        result_html = p.transform("<h1>Hello</h1>")
+        ok_('<h1 style="color:red">Hello</h1>' in result_html)
+        mocked_session.get.assert_called_once_with(
+            "https://example.com/site.css", verify=True, timeout=2.5
+        )
+
+    def test_transform_many(self):
+        htmls = ["<h1>Hi %d</h1><p>Yes</p>" % i for i in range(5)]
+        options = {"css_text": "h1 { color: red } p { color: blue }"}
+        expected = [transform(html, **options) for html in htmls]
+
+        eq_(transform_many(htmls, workers=2, **options), expected)
+
+        results = transform_many(htmls, workers=2, ordered=False, **options)
+        eq_(sorted(results), list(enumerate(expected)))
+
+    def test_transform_in_worker(self):
+        options = {"css_text": "h1 { color: red }"}
+        pickled = pickle.dumps(options)
+        with mock.patch.object(premailer.premailer, "_worker", None):
+            eq_(
+                premailer.premailer._transform_in_worker(pickled, False, "<h1>Hi</h1>"),
+                transform("<h1>Hi</h1>", **options),
+            )
+            stylesheet = premailer.premailer._worker[1]
+            premailer.premailer._transform_in_worker(pickled, False, "<h1>Yo</h1>")
+            # Compiled once per process for the same options.
+            ok_(premailer.premailer._worker[1] is stylesheet)
+            other = pickle.dumps({"css_text": "h1 { color: blue }"})
+            ok_(
+                '<h1 style="color:blue">'
+                in premailer.premailer._transform_in_worker(other, False, "<h1>Hi</h1>")
+            )
+            ok_(premailer.premailer._worker[1] is not stylesheet)
+
+    def test_transform_to(self):
+        html = """<!DOCTYPE html>
+        <html>
+        <head>
+        <style type="text/css">
+        h1 { color: red }
+        a:hover { color: blue }
+        </style>
+        </head>
+        <body>
+        <h1>Hello</h1>
+        <a href="{{ url }}">Link</a>
+        </body>
+        </html>"""
+        for options in (
+            {},
+            {"method": "xml"},
+            {"preserve_handlebar_syntax": True},
+            {"base_url": "http://example.com"},
+        ):
+            f = BytesIO()
+            Premailer(html, **options).transform_to(f)
+            eq_(f.getvalue().decode("utf-8"), Premailer(html, **options).transform())
+
+        f = BytesIO()
+        stylesheet = Premailer(css_text="p { color: red }").compile()
+        stylesheet.apply_to(f, "<p>Hi</p>", pretty_print=False)
+        eq_(
+            f.getvalue(),
+            b'<html><head></head><body><p style="color:red">Hi</p></body></html>',
+        )
+
+    def test_substituting_writer(self):
+        data = (
+            b'<style><![CDATA[a:hover { color: blue }]]></style>'
+            b'<a href="%7B%7Burl%7D%7D">x</a><![CDATA[ ="%7B%7Bx%7D%7D" ]]>'
+        )
+        substitutions = [
+            (b"<![CDATA[", re.compile(rb"<!\[CDATA\[(.*?)\]\]>"), rb"[\1]"),
+            (b'="%7B%7B', re.compile(rb'="%7B%7B(.+?)%7D%7D"'), rb'="{{\1}}"'),
+        ]
+        expected = data
+        for opening, regex, replacement in substitutions:
+            expected = regex.sub(replacement, expected)
+        for size in (1, 2, 3, 7, len(data)):
+            f = BytesIO()
+            writer = _SubstitutingWriter(f, substitutions)
+            for i in range(0, len(data), size):
+                end = i + size
+                writer.write(data[i:end])
+            writer.close()
+            eq_(f.getvalue(), expected)
+
+    def test_compile_template(self):
+        html = """<html>
+        <head>
+        <style>p { color: red } a { color: {{color}} }</style>
+        </head>
+        <body>
+        <p>Hello {{ first_name }}, {{{ body }}}</p>
+        <a href="{{url}}" title="{{ title | default: "Test & <code>" }}">Hi</a>
+        <img src="logo.png" alt="{{first_name}}">
+        </body>
+        </html>"""
+
+        expect_html = """<html>
+        <head>
+        </head>
+        <body>
+        <p style="color:red">Hello Ann, <b>Hi</b></p>
+        <a href="https://example.com/" title="T &amp; C" style="color:{{color}}">Hi</a>
+        <img src="https://example.org/logo.png" alt="Ann">
+        </body>
+        </html>"""
+
+        template = Premailer(
+            html, base_url="https://example.org", disable_validation=True
+        ).compile_template()
+        eq_(
+            template.names,
+            (
+                "first_name",
+                "body",
+                "url",
+                'title | default: "Test & <code>"',
+                "color",
+                "first_name",
+            ),
+        )
+        eq_(len(template.segments), len(template.tags) + 1)
+        for i in range(2):
+            result_html = template.render(
+                {
+                    "first_name": "Ann",
+                    "url": "https://example.com/",
+                    'title | default: "Test & <code>"': "T &amp; C",
+                },
+                body="<b>Hi</b>",
+            )
+            compare_html(expect_html, result_html)
+
+        # Tags without a value are left as they were.
+        ok_(
+            '<a href="{{url}}" title="{{ title | default: "Test & <code>" }}"'
+            in template.render(first_name="Ann")
+        )
+
+        stylesheet = Premailer(css_text="p { color: blue }").compile()
+        template = stylesheet.compile_template("<p>Hi {{name}}</p>", pretty_print=False)
+        eq_(
+            template.render(name="Bob"),
+            '<html><head></head><body><p style="color:blue">Hi Bob</p></body></html>',
+        )
+
+        tree = fromstring("<html><body><p>Hi</p></body></html>")
+        assert_raises(TypeError, Premailer().compile_template, tree)
+
+    def test_bytes(self):
+        html = "<html><head><style>p { color: red }</style></head><body><p>\u20ac</p>"
+        expect_html = (
+            '<html><head></head><body><p style="color:red">\u20ac</p></body></html>'
+        )
+
+        # UTF-8 unless it says otherwise.
+        for data in (html.encode("utf-8"), memoryview(html.encode("utf-8"))):
+            eq_(Premailer(data).transform(pretty_print=False), expect_html)
+            eq_(
+                Premailer(data).transform(pretty_print=False, output="bytes"),
+                expect_html.encode("utf-8"),
+            )
+        eq_(
+            Premailer(html).transform(pretty_print=False, output="bytes"),
+            expect_html.encode("utf-8"),
+        )
+
+        html = html.replace("<head>", '<head><meta charset="windows-1252">')
+        expect_html = expect_html.replace(
+            "<head>", '<head><meta charset="windows-1252">'
+        )
+        data = html.encode("windows-1252")
+        eq_(Premailer(data).transform(pretty_print=False), expect_html)
+        eq_(transform(data, output="bytes"), expect_html.encode("windows-1252"))
+        eq_(
+            Premailer(data).transform(
+                pretty_print=False, output="bytes", encoding="utf-8"
+            ),
+            expect_html.encode("utf-8"),
+        )
+
+        data = b"<!DOCTYPE html>\n<html><body><p>Hi</p></body></html>"
+        ok_(transform(data, output="bytes").startswith(b"<!DOCTYPE html>"))
+        assert_raises(ValueError, transform, data, output="text")
@@ -0,0 +1,116 @@
+import asyncio
+import unittest
+
+import mock
+
+from premailer.aio import Response
+from premailer.premailer import Premailer
+from premailer.result_cache import Result, ResultCache
+
+
+URL = "https://example.com/brand.css"
+
+HTML = """<html>
+<head><link rel="stylesheet" href="%s"></head>
+<body><h1>Hi</h1><p>There</p></body>
+</html>""" % URL
+
+
+class Counter(object):
+    def __init__(self):
+        self.transforms = 0
+
+    def __call__(self, event, name, data):
+        if event == "start" and name == "merge":
+            self.transforms += 1
+
+
+class TestResultCache(unittest.TestCase):
+    def test_premailer(self):
+        stylesheets = {URL: "h1 { color: red }"}
+        cache = ResultCache()
+        counter = Counter()
+
+        def transform(html=HTML, **options):
+            with mock.patch.object(
+                Premailer, "_load_external_url", side_effect=stylesheets.get
+            ):
+                return Premailer(
+                    css_text="p { color: blue }",
+                    result_cache=cache,
+                    instrumentation=counter,
+                    **options
+                ).transform(html)
+
+        result_html = transform()
+        self.assertIn('<h1 style="color:red">Hi</h1>', result_html)
+        self.assertIn('<p style="color:blue">There</p>', result_html)
+        self.assertEqual(transform(), result_html)
+        self.assertEqual(counter.transforms, 1)
+
+        # Other options, html or stylesheets.
+        transform(base_url="https://example.org")
+        self.assertEqual(counter.transforms, 2)
+        transform(HTML.replace("There", "Here"))
+        self.assertEqual(counter.transforms, 3)
+        stylesheets[URL] = "h1 { color: green }"
+        self.assertIn('<h1 style="color:green">Hi</h1>', transform())
+        self.assertEqual(counter.transforms, 4)
+        transform()
+        self.assertEqual(counter.transforms, 4)
+
+        # A compiled stylesheet.
+        stylesheet = Premailer(
+            css_text="p { color: blue }", result_cache=cache, instrumentation=counter
+        ).compile()
+        with mock.patch.object(
+            Premailer, "_load_external_url", side_effect=stylesheets.get
+        ):
+            self.assertEqual(stylesheet.apply(HTML), transform())
+            self.assertEqual(stylesheet.apply(HTML), transform())
+        self.assertEqual(counter.transforms, 5)
+
+    def test_atransform(self):
+        stylesheets = {URL: "h1 { color: red }"}
+        session = mock.MagicMock()
+        session.get.side_effect = lambda url, **kwargs: Response(
+            url, 200, stylesheets[url]
+        )
+        cache = ResultCache()
+        counter = Counter()
+
+        def atransform():
+            p = Premailer(result_cache=cache, instrumentation=counter, session=session)
+            loop = asyncio.new_event_loop()
+            try:
+                return loop.run_until_complete(p.atransform(HTML))
+            finally:
+                loop.close()
+
+        result_html = atransform()
+        self.assertIn('<h1 style="color:red">Hi</h1>', result_html)
+        self.assertEqual(atransform(), result_html)
+        self.assertEqual(counter.transforms, 1)
+        self.assertEqual(session.get.call_count, 2)
+        stylesheets[URL] = "h1 { color: green }"
+        self.assertIn('<h1 style="color:green">Hi</h1>', atransform())
+        self.assertEqual(counter.transforms, 2)
+
+    def test_maxbytes(self):
+        cache = ResultCache(maxbytes=10)
+        cache.set("a", Result([], "", "a" * 6))
+        cache.set("b", Result([], "", "b" * 6))
+        cache.set("c", Result([], "", "c" * 11))
+        self.assertEqual(cache.get("a"), None)
+        self.assertEqual(cache.get("b").html, "b" * 6)
+        self.assertEqual(cache.get("c"), None)
+
+    def test_storage(self):
+        storage = {}
+        cache = ResultCache(storage=storage)
+        p = Premailer(css_text="p { color: red }", result_cache=cache)
+        result_html = p.transform("<p>Hi</p>")
+        (result,) = storage.values()
+        self.assertEqual(result, Result([], result.stylesheets, result_html))
+        cache.clear()
+        self.assertEqual(storage, {})
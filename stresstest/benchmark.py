@@ -0,0 +1,306 @@
+"""Benchmarks premailer on the samples and on synthetic documents.
+
+    python benchmark.py --output results.json
+    python benchmark.py --compare results.json --threshold 10
+
+For every workload the time spent in each phase, documents per second
+(with cold and warm caches) and peak memory are measured. With
+``--compare`` the results are compared with an earlier results file and
+the exit code is 1 if anything got slower by more than the threshold.
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import sys
+import time
+import tracemalloc
+
+from lxml import etree
+
+from premailer import cache
+from premailer.instrumentation import Timings
+from premailer.premailer import Premailer
+
+_root = os.path.join(os.path.dirname(__file__), "samples")
+
+# Phases that take less than this are too noisy to compare.
+MINIMUM_SECONDS = 0.0001
+
+
+def samples():
+    """Yields ``(name, html, options)`` of the samples."""
+    for name in sorted(os.listdir(_root)):
+        directory = os.path.join(_root, name)
+        if not os.path.isdir(directory):
+            continue
+        with open(os.path.join(directory, "input.html")) as f:
+            html = f.read()
+        try:
+            with open(os.path.join(directory, "options.json")) as f:
+                options = json.load(f)
+        except FileNotFoundError:
+            options = {}
+        yield "sample-%s" % name, html, options
+
+
+_tags = ("div", "p", "span", "a", "td", "li", "h1", "h2", "strong", "em")
+_properties = (
+    ("color", ("red", "#333", "#abcdef", "black")),
+    ("font-size", ("12px", "14px", "1.2em", "80%")),
+    ("margin", ("0", "0 auto", "10px 5px")),
+    ("padding", ("0", "4px", "2px 8px")),
+    ("text-align", ("left", "center", "right")),
+    ("background-color", ("#fff", "#eee", "transparent")),
+    ("font-family", ("Arial, sans-serif", "'Helvetica Neue', Helvetica")),
+)
+
+
+def generate_stylesheet(rules, classes=50, seed=0):
+    """Returns a stylesheet of about ``rules`` rules with a mix of type,
+    class, id, descendant and child selectors, pseudo-classes and media
+    queries."""
+    rng = random.Random(seed)
+
+    def selector():
+        kind = rng.random()
+        if kind < 0.3:
+            return "%s.c%d" % (rng.choice(_tags), rng.randrange(classes))
+        if kind < 0.5:
+            return ".c%d" % rng.randrange(classes)
+        if kind < 0.6:
+            return "#id%d" % rng.randrange(classes)
+        if kind < 0.8:
+            return "%s .c%d %s" % (
+                rng.choice(_tags),
+                rng.randrange(classes),
+                rng.choice(_tags),
+            )
+        if kind < 0.9:
+            return "%s > %s" % (rng.choice(_tags), rng.choice(_tags))
+        return "a.c%d:hover" % rng.randrange(classes)
+
+    def block():
+        declarations = rng.sample(_properties, rng.randint(1, 4))
+        return "; ".join(
+            "%s: %s" % (name, rng.choice(values)) for name, values in declarations
+        )
+
+    lines = []
+    for i in range(rules):
+        if i % 50 == 49:
+            lines.append(
+                "@media only screen and (max-width: 600px) { %s { %s } }"
+                % (selector(), block())
+            )
+        else:
+            lines.append("%s { %s }" % (selector(), block()))
+    return "\n".join(lines)
+
+
+def generate_document(elements, classes=50, stylesheet="", seed=0):
+    """Returns an html document with about ``elements`` elements nested a
+    few levels deep, with classes, ids and links."""
+    rng = random.Random(seed)
+    parts = ["<html><head><style>%s</style></head><body>" % stylesheet]
+    count = 0
+    while count < elements:
+        parts.append('<div class="c%d">' % rng.randrange(classes))
+        count += 1
+        for i in range(rng.randint(1, 10)):
+            tag = rng.choice(_tags)
+            attributes = ' class="c%d c%d"' % (
+                rng.randrange(classes),
+                rng.randrange(classes),
+            )
+            if rng.random() < 0.05:
+                attributes += ' id="id%d"' % rng.randrange(classes)
+            if tag == "a":
+                attributes += ' href="/page/%d"' % count
+            parts.append("<%s%s>Text <em>%d</em></%s>" % (tag, attributes, count, tag))
+            count += 2
+        parts.append('<img src="/img/%d.png" style="float: left"></div>' % count)
+        count += 1
+    parts.append("</body></html>")
+    return "".join(parts)
+
+
+def synthetic(elements, rules):
+    name = "synthetic-%de-%dr" % (elements, rules)
+    stylesheet = generate_stylesheet(rules)
+    html = generate_document(elements, stylesheet=stylesheet)
+    return name, html, {"base_url": "https://example.com/"}
+
+
+def measure(html, options, iterations, warm):
+    """Transforms the html ``iterations`` times and returns the time it
+    took and the time spent in each phase, per document."""
+    options = dict(options)
+    pretty_print = options.pop("pretty_print", False)
+    if warm:
+        # Fill the caches
+        Premailer(html, **options).transform(pretty_print=pretty_print)
+    timings = Timings()
+    total = 0.0
+    for i in range(iterations):
+        if not warm:
+            cache.clear()
+        t0 = time.perf_counter()
+        Premailer(html, instrumentation=timings, **options).transform(
+            pretty_print=pretty_print
+        )
+        total += time.perf_counter() - t0
+    return {
+        "seconds": total / iterations,
+        "documents_per_second": iterations / total,
+        "phases": {
+            phase: timings.totals[phase]["seconds"] / iterations
+            for phase in sorted(timings.totals)
+        },
+    }
+
+
+def peak_memory(html, options):
+    """Returns the peak of memory allocated by Python during one transform,
+    in bytes."""
+    options = dict(options)
+    pretty_print = options.pop("pretty_print", False)
+    cache.clear()
+    tracemalloc.start()
+    try:
+        Premailer(html, **options).transform(pretty_print=pretty_print)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run(workloads, iterations, memory):
+    results = {}
+    for name, html, options in workloads:
+        result = {
+            "bytes": len(html),
+            "cold": measure(html, options, iterations, warm=False),
+            "warm": measure(html, options, iterations, warm=True),
+        }
+        if memory:
+            result["peak_memory"] = peak_memory(html, options)
+        results[name] = result
+        print(
+            "%-28s %8.2fms cold %8.2fms warm %9.1f docs/s"
+            % (
+                name,
+                result["cold"]["seconds"] * 1000,
+                result["warm"]["seconds"] * 1000,
+                result["warm"]["documents_per_second"],
+            )
+        )
+        print(
+            " " * 28
+            + " ".join(
+                "%s=%.2fms" % (phase, seconds * 1000)
+                for phase, seconds in result["warm"]["phases"].items()
+                if seconds
+            )
+        )
+    # On Linux ru_maxrss is in kilobytes, on macOS in bytes.
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        peak_rss *= 1024
+    return {
+        "python": sys.version.split()[0],
+        "lxml": ".".join(str(x) for x in etree.LXML_VERSION),
+        "iterations": iterations,
+        "peak_rss": peak_rss,
+        "workloads": results,
+    }
+
+
+def compare(results, baseline, threshold):
+    """Prints how the results compare with the baseline and returns the
+    regressions of more than ``threshold`` percent."""
+    regressions = []
+    for name, result in sorted(results["workloads"].items()):
+        try:
+            before = baseline["workloads"][name]
+        except KeyError:
+            continue
+        metrics = [
+            ("%s %s" % (cache_, phase), before[cache_]["phases"].get(phase), seconds)
+            for cache_ in ("cold", "warm")
+            for phase, seconds in result[cache_]["phases"].items()
+            if phase in before[cache_]["phases"]
+        ]
+        metrics.extend(
+            (cache_, before[cache_]["seconds"], result[cache_]["seconds"])
+            for cache_ in ("cold", "warm")
+        )
+        if "peak_memory" in result and "peak_memory" in before:
+            metrics.append(
+                ("peak_memory", before["peak_memory"], result["peak_memory"])
+            )
+        for metric, old, new in metrics:
+            if not old or (metric != "peak_memory" and old < MINIMUM_SECONDS):
+                # Too quick to tell
+                continue
+            change = (new - old) * 100.0 / old
+            if change > threshold:
+                regressions.append((name, metric, change))
+            if metric in ("cold", "warm", "peak_memory") or change > threshold:
+                print("%-28s %-24s %+7.1f%%" % (name, metric, change))
+    return regressions
+
+
+def main(args):
+    parser = argparse.ArgumentParser(usage="python benchmark.py [options]")
+
+    parser.add_argument("--iterations", default=10, type=int)
+    parser.add_argument(
+        "--elements",
+        default="1000,10000",
+        help="Comma separated sizes of synthetic documents",
+    )
+    parser.add_argument(
+        "--rules",
+        default="100,1000",
+        help="Comma separated sizes of synthetic stylesheets",
+    )
+    parser.add_argument("--no-samples", action="store_true")
+    parser.add_argument(
+        "--memory", action="store_true", help="Measure peak memory (slow)"
+    )
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Compare with this JSON results file")
+    parser.add_argument(
+        "--threshold",
+        default=10.0,
+        type=float,
+        help="Percentage by which something may get slower (default 10)",
+    )
+
+    options = parser.parse_args(args)
+
+    workloads = [] if options.no_samples else list(samples())
+    for elements in filter(None, options.elements.split(",")):
+        for rules in filter(None, options.rules.split(",")):
+            workloads.append(synthetic(int(elements), int(rules)))
+
+    results = run(workloads, options.iterations, options.memory)
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, options.threshold)
+        if regressions:
+            print(
+                "%d regressions of more than %s%%"
+                % (len(regressions), options.threshold)
+            )
+            return 1
+    return 0
+
+
+if __name__ == "__main__":  # pragma: no cover
+    sys.exit(main(sys.argv[1:]))
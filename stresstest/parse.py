@@ -0,0 +1,66 @@
+import argparse
+import os
+import time
+
+from lxml import etree
+
+from premailer.parsing import PARSERS
+
+_root = os.path.join(os.path.dirname(__file__), "samples")
+samples = sorted(
+    os.path.join(_root, x)
+    for x in os.listdir(_root)
+    if os.path.isdir(os.path.join(_root, x))
+)
+
+
+def stylesheets():
+    """The text of every <style> in the samples."""
+    for sample in samples:
+        with open(os.path.join(sample, "input.html")) as f:
+            page = etree.fromstring(f.read(), etree.HTMLParser())
+        for style in page.iter("style"):
+            if style.text:
+                yield os.path.basename(sample), style.text
+
+
+def run(iterations, validate):
+    sheets = list(stylesheets())
+    names = sorted(PARSERS)
+    print("sample".ljust(10) + "".join(name.rjust(14) for name in names))
+    totals = dict.fromkeys(names, 0.0)
+    for sample, css_body in sheets:
+        line = sample.ljust(10)
+        for name in names:
+            parse = PARSERS[name]
+            t0 = time.perf_counter()
+            for i in range(iterations):
+                parse(css_body, validate=validate)
+            took = time.perf_counter() - t0
+            totals[name] += took
+            line += ("%.2fms" % (took * 1000 / iterations)).rjust(14)
+        print(line)
+    print(
+        "total".ljust(10)
+        + "".join(
+            ("%.2fms" % (totals[name] * 1000 / iterations)).rjust(14) for name in names
+        )
+    )
+
+
+def main(args):
+    parser = argparse.ArgumentParser(usage="python parse.py [options]")
+
+    parser.add_argument("--iterations", default=100, type=int)
+    parser.add_argument("--validate", action="store_true")
+
+    options = parser.parse_args(args)
+
+    run(options.iterations, options.validate)
+    return 0
+
+
+if __name__ == "__main__":  # pragma: no cover
+    import sys
+
+    sys.exit(main(sys.argv[1:]))